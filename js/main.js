@@ -228,44 +228,40 @@ var main = {
     // JP map overview
     if ($("#map-jp-overview").length > 0) {
       try {
-        // load data from firebase storage
-        const fileRef = storage.ref("prefecture-by-date.json");
+        // load the simplified map with the values joined to its features
+        const fileRef = storage.ref("prefecture-map.json");
         const url = await fileRef.getDownloadURL().catch((e) => {
           throw e;
         });
-        const metadata = await fileRef.getMetadata().catch((e) => {
-          throw e;
-        });
         const response = await fetch(url).catch((e) => {
           throw e;
         });
-        const responseData = await response.json().catch((e) => {
+        const mapData = await response.json().catch((e) => {
           throw e;
         });
 
-        const data = _.chain(responseData)
-          .mapValues((value, key) => {
+        const data = _.chain(mapData.features)
+          .map("properties")
+          .filter((properties) => properties.value !== undefined)
+          .map((properties) => {
             return {
-              prefecture: value["Tỉnh/Thành phố"],
-              value: value["Tổng"],
+              "hc-key": properties["hc-key"],
+              value: properties.value,
+              new_cases: properties.new_cases,
+              average: properties.average,
+              week_over_week: properties.week_over_week,
+              average_rate: properties.average_rate,
             };
           })
-          .values()
           .value();
 
         // prepare data to render
-        const updatedAt = _.chain(responseData)
-          .first()
-          .omit(["Tỉnh/Thành phố", "Tổng"])
-          .keys()
-          .map((d) => moment(`2020/${d}`))
-          .max()
-          .value();
+        const updatedAt = moment(`2020/${mapData.date}`);
 
         // Create the chart
         Highcharts.mapChart("map-jp-overview", {
           chart: {
-            map: "countries/jp/jp-all",
+            map: mapData,
             panning: {
               enabled: true,
               type: "xy",
@@ -302,16 +298,13 @@ var main = {
                 enabled: true,
                 format: "{point.name}",
               },
-              joinBy: ["name", "prefecture"],
+              joinBy: "hc-key",
               nullInteraction: true,
             },
             {
               name: "Separators",
               type: "mapline",
-              data: Highcharts.geojson(
-                Highcharts.maps["countries/jp/jp-all"],
-                "mapline"
-              ),
+              data: Highcharts.geojson(mapData, "mapline"),
               color: "silver",
               nullColor: "silver",
               showInLegend: false,
@@ -326,6 +319,18 @@ var main = {
               // If not null, use the default formatter
               return tooltip.defaultFormatter.call(this, tooltip);
             },
+            pointFormatter: function () {
+              // metrics of the latest day, null when undefined e.g. without cases
+              const metric = (value, digits) =>
+                value === null || value === undefined ? "-" : value.toFixed(digits);
+              return (
+                `${this.name}: <b>${this.value.toLocaleString()}</b><br/>` +
+                `Ca mới: ${metric(this.new_cases, 0)}<br/>` +
+                `Trung bình 7 ngày: ${metric(this.average, 1)}<br/>` +
+                `So với tuần trước: ${metric(this.week_over_week, 2)}<br/>` +
+                `Trên 100.000 dân (trung bình 7 ngày): ${metric(this.average_rate, 2)}`
+              );
+            },
           },
         });
 
@@ -560,6 +565,12 @@ var main = {
         renderHeatmap(data, CHUGOKU);
         renderHeatmap(data, SHIKOKU);
         renderHeatmap(data, KYUSHU_OKINAWA);
+
+        // refresh the prefecture table rendered at build time
+        renderPrefectureTable(data);
+        $("[data-id='prefecture-table-updated-at']").text(
+          `Cập nhật lúc ${moment(metadata.updated).format("HH:mm DD/MM/YYYY")}.`
+        );
       } catch ($error) {
         console.error($error);
       }
@@ -571,6 +582,37 @@ var main = {
 
 document.addEventListener("DOMContentLoaded", main.init);
 
+function renderPrefectureTable(data) {
+  const tbody = $("#covi-prefecture-table-body");
+  if (tbody.length === 0) {
+    return;
+  }
+
+  const rows = _.chain(data)
+    .map((d) => {
+      const values = _.values(d.value);
+      const lastWeek = _.takeRight(values, 7);
+      return {
+        name: d.prefecture,
+        total: _.sum(values),
+        new: _.last(values) || 0,
+        average: _.sum(lastWeek) / Math.max(lastWeek.length, 1),
+      };
+    })
+    .orderBy(["total"], ["desc"])
+    .value();
+
+  tbody.html(
+    rows
+      .map(
+        (row) =>
+          `<tr><td>${row.name}</td><td>${row.total.toLocaleString()}</td>` +
+          `<td>${row.new.toLocaleString()}</td><td>${row.average.toFixed(1)}</td></tr>`
+      )
+      .join("")
+  );
+}
+
 function renderHeatmap(data, areaObject) {
   const LIMIT = 90;
 
@@ -0,0 +1,168 @@
+import fnmatch
+import hashlib
+import json
+import threading
+import time
+
+
+# Estimated cost of fetching one artifact from the site: a getDownloadURL
+# round trip plus the fetch itself
+ROUND_TRIP_SECONDS = 0.25
+
+
+class Bundle(object):
+    """Related artifacts packed into one file with an offset/length index.
+
+    `<name>.pack` starts with a JSON index on its first line, followed by
+    the members. Member offsets in that index are relative to the end of the
+    first line, so the whole pack can be fetched once and split. For HTTP
+    Range requests of single members, `<name>.pack.json` holds the same
+    index with absolute offsets.
+
+    A pack is only uploaded with the members of all the `expected` datasets,
+    so that a run of a subset of them, or with failed datasets, does not
+    drop members: those are taken from the previously uploaded pack.
+    """
+
+    def __init__(self, name, patterns=None, expected=None):
+        """
+        expected
+            names of the datasets the pack must hold, e.g. the registered
+            datasets matching the patterns
+        """
+        self.name = name
+        self.patterns = patterns or []
+        self.expected = set(expected or [])
+        self.members = {}
+        # Datasets whose payloads were added in this run
+        self.datasets = set()
+        self._lock = threading.Lock()
+
+    @property
+    def storage_ref(self):
+        return f'bundles/{self.name}.pack'
+
+    def matches(self, dataset_name):
+        return any(fnmatch.fnmatchcase(dataset_name, pattern) for pattern in self.patterns)
+
+    def add(self, storage_ref, data):
+        with self._lock:
+            self.members[storage_ref] = data.encode() if isinstance(data, str) else data
+
+    def add_payloads(self, payloads, dataset_name=None):
+        for storage_ref, data_str in payloads:
+            self.add(storage_ref, data_str)
+        if dataset_name is not None:
+            with self._lock:
+                self.datasets.add(dataset_name)
+
+    def read_pack(self, bucket):
+        """
+        returns
+            {storage_ref: bytes} of the previously uploaded pack, empty if none
+        """
+        blob = bucket.blob(self.storage_ref)
+        if not blob.exists():
+            return {}
+        pack = blob.download_as_string()
+        start = pack.index(b'\n') + 1
+        header = json.loads(pack[:start])
+        return {
+            storage_ref: pack[start + member['offset']:start + member['offset'] + member['length']]
+            for storage_ref, member in header['members'].items()
+        }
+
+    def complete(self, bucket):
+        """Add the members of the expected datasets missing from this run from the previous pack.
+
+        returns
+            names of the expected datasets still missing
+        """
+        missing = self.expected - self.datasets
+        if not missing:
+            return missing
+
+        reused = set()
+        for storage_ref, data in self.read_pack(bucket).items():
+            # Payloads of a dataset are stored as `<name>.<ext>` or `<name>/...`
+            owner = next((name for name in missing if storage_ref.startswith((f'{name}.', f'{name}/'))), None)
+            if owner is not None:
+                self.add(storage_ref, data)
+                reused.add(owner)
+        if reused:
+            print(f'Bundle {self.name}: reused the previous members of {", ".join(sorted(reused))}')
+        return missing - reused
+
+    def render(self):
+        """
+        returns
+            (pack bytes, index with absolute offsets)
+        """
+        offsets = {}
+        position = 0
+        for storage_ref in sorted(self.members):
+            data = self.members[storage_ref]
+            offsets[storage_ref] = {
+                'offset': position,
+                'length': len(data),
+                'sha1': hashlib.sha1(data).hexdigest(),
+            }
+            position += len(data)
+
+        header = json.dumps({'name': self.name, 'members': offsets}, separators=(',', ':')).encode() + b'\n'
+        body = b''.join(self.members[storage_ref] for storage_ref in sorted(self.members))
+        index = {
+            'name': self.name,
+            'ref': self.storage_ref,
+            'size': len(header) + len(body),
+            'members': {
+                ref: {**member, 'offset': len(header) + member['offset']} for ref, member in offsets.items()
+            },
+        }
+        return header + body, index
+
+    def upload(self, bucket):
+        if not self.members:
+            return None
+        missing = self.complete(bucket)
+        if missing:
+            print(f'Bundle {self.name}: not uploaded, no members of {", ".join(sorted(missing))}')
+            return None
+
+        start = time.perf_counter()
+        pack, index = self.render()
+        bucket.blob(self.storage_ref).upload_from_string(pack, content_type='application/octet-stream')
+        bucket.blob(f'{self.storage_ref}.json').upload_from_string(
+            json.dumps(index), content_type='application/json')
+        elapsed = time.perf_counter() - start
+
+        print(
+            f'Bundle {self.name}: {len(self.members)} members, {len(pack)} bytes, uploaded in {elapsed:.2f}s; '
+            f'clients save {len(self.members) - 1} requests, about {(len(self.members) - 1) * ROUND_TRIP_SECONDS:.1f}s '
+            f'of sequential round trips'
+        )
+        return self.storage_ref
+
+
+class Bundler(object):
+    """Route the serialized payloads of datasets into the bundles whose patterns match them."""
+
+    def __init__(self, bundles):
+        self.bundles = bundles
+
+    def add(self, dataset_name, payloads):
+        for bundle in self.bundles:
+            if bundle.matches(dataset_name):
+                bundle.add_payloads(payloads, dataset_name)
+
+    def upload(self, bucket):
+        """
+        returns
+            list of uploaded bundle refs
+        """
+        uploaded = []
+        for bundle in self.bundles:
+            storage_ref = bundle.upload(bucket)
+            if storage_ref is not None:
+                uploaded.append(storage_ref)
+        return uploaded
@@ -0,0 +1,277 @@
+import argparse
+import collections
+import functools
+import gzip
+import hashlib
+import http.server
+import json
+import sys
+import threading
+import time
+import traceback
+import urllib.parse
+
+import numpy as np
+
+import datasets
+import update_data
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8000
+DEFAULT_REFRESH = 600  # Seconds between reloads of the datasets
+QUERY_CACHE_SIZE = 256
+GZIP_MIN_BYTES = 1024
+
+
+class Artifact(object):
+    """A response body kept in memory both plain and gzipped, with its strong ETag."""
+
+    def __init__(self, body, content_type='application/json'):
+        self.body = body
+        self.gzipped = gzip.compress(body, compresslevel=6) if len(body) >= GZIP_MIN_BYTES else None
+        sha1 = hashlib.sha1(body).hexdigest()
+        self.etag = f'"{sha1}"'
+        self.gzip_etag = f'"{sha1}-gzip"'
+        self.content_type = content_type
+
+
+class DatasetIndex(object):
+    """In-memory indexes over a dataset's frame for filtered queries.
+
+    Rows are indexed by prefecture (positions per value) and by date (day
+    numbers sorted once, so a date range is two binary searches).
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.frame = dataset.dataframe
+        self.prefecture_column = dataset.SHARD_PREFECTURE_COLUMN
+        self.date_column = dataset.SHARD_DATE_COLUMN or next(iter(dataset.DATE_OUTPUT_FORMATS), None)
+
+        self.prefectures = {}
+        if self.prefecture_column in self.frame:
+            codes, uniques = self.frame[self.prefecture_column].factorize()
+            order = np.argsort(codes, kind='stable')
+            bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+            self.prefectures = {
+                str(dataset.label(self.prefecture_column, value)): order[bounds[i]:bounds[i + 1]]
+                for i, value in enumerate(uniques)
+            }
+
+        self.date_order = None
+        if self.date_column in self.frame and self.frame[self.date_column].dtype.kind == 'M':
+            days = datasets.day_numbers(self.frame[self.date_column])
+            self.date_order = np.argsort(days, kind='stable')
+            self.sorted_days = days[self.date_order]
+
+    def _date_positions(self, start, end):
+        lo = np.searchsorted(self.sorted_days, 0 if start is None else _day_number(start), side='left')
+        hi = len(self.sorted_days) if end is None else np.searchsorted(
+            self.sorted_days, _day_number(end), side='right')
+        return self.date_order[lo:hi]
+
+    def query(self, prefecture=None, start=None, end=None, columns=None):
+        """
+        returns
+            filtered Dataframe
+        """
+        positions = None
+        if prefecture is not None:
+            if not self.prefectures:
+                raise ValueError(f'{self.dataset.name} cannot be filtered by prefecture')
+            positions = self.prefectures.get(prefecture, np.array([], dtype=np.intp))
+        if start is not None or end is not None:
+            if self.date_order is None:
+                raise ValueError(f'{self.dataset.name} cannot be filtered by date')
+            in_range = self._date_positions(start, end)
+            positions = in_range if positions is None else np.intersect1d(positions, in_range)
+
+        frame = self.frame if positions is None else self.frame.iloc[np.sort(positions)]
+        if columns:
+            unknown = [column for column in columns if column not in frame]
+            if unknown:
+                raise ValueError(f'Unknown columns: {", ".join(unknown)}')
+            frame = frame[columns]
+        return frame
+
+
+def _day_number(date):
+    return int((np.datetime64(date, 'D') - datasets.EPOCH).astype(np.int64))
+
+
+class DataStore(object):
+    """Latest outputs of the datasets, swapped atomically on each reload."""
+
+    def __init__(self, dataset_factory=update_data.detailed_datasets):
+        self.dataset_factory = dataset_factory
+        self.artifacts = {}
+        self.indexes = {}
+        # {dataset name: storage refs of its artifacts}
+        self.refs = {}
+        self.loaded = None
+        self._query_cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self):
+        start = time.perf_counter()
+        artifacts = {}
+        indexes = {}
+        refs = {}
+        for dataset in self.dataset_factory():
+            try:
+                dataset.query_all()
+                payloads = dataset.serialize()
+            except Exception:
+                print(f'Failed to load dataset {dataset.name}')
+                traceback.print_exc()
+                # Keep serving the previous version, in every language
+                refs[dataset.name] = self.refs.get(dataset.name, [])
+                artifacts.update({ref: self.artifacts[ref] for ref in refs[dataset.name]})
+                if dataset.name in self.indexes:
+                    indexes[dataset.name] = self.indexes[dataset.name]
+                continue
+
+            for storage_ref, data_str in payloads:
+                artifacts[storage_ref] = Artifact(data_str.encode())
+            refs[dataset.name] = [storage_ref for storage_ref, _ in payloads]
+            indexes[dataset.name] = DatasetIndex(dataset)
+
+        with self._lock:
+            self.artifacts = artifacts
+            self.indexes = indexes
+            self.refs = refs
+            self.loaded = time.time()
+            self._query_cache.clear()
+        print(f'Loaded {len(indexes)} datasets, {len(artifacts)} artifacts in {time.perf_counter() - start:.2f}s')
+
+    def artifact(self, storage_ref):
+        return self.artifacts.get(storage_ref)
+
+    def query(self, name, prefecture=None, start=None, end=None, columns=None):
+        """
+        returns
+            Artifact of the filtered rows, or None for an unknown dataset
+        """
+        key = (name, prefecture, start, end, tuple(columns or ()))
+        with self._lock:
+            if key in self._query_cache:
+                self._query_cache.move_to_end(key)
+                return self._query_cache[key]
+            index = self.indexes.get(name)
+        if index is None:
+            return None
+
+        frame = index.query(prefecture, start, end, columns)
+        artifact = Artifact(index.dataset.to_json(frame).encode())
+        with self._lock:
+            self._query_cache[key] = artifact
+            if len(self._query_cache) > QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+        return artifact
+
+
+class DataRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    GET /data/<storage_ref>
+        Artifact as uploaded to storage, e.g. /data/prefecture-by-date.json
+    GET /query/<name>?prefecture=&from=YYYY-MM-DD&to=YYYY-MM-DD&columns=a,b
+        Filtered rows of a dataset
+    """
+
+    store = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, artifact=None, message=None):
+        if artifact is None:
+            artifact = Artifact(json.dumps({'error': message}).encode())
+
+        # Each encoding is a distinct representation with its own strong ETag
+        gzipped = artifact.gzipped is not None and 'gzip' in self.headers.get('Accept-Encoding', '')
+        etag = artifact.gzip_etag if gzipped else artifact.etag
+        if status == 200 and etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            status = 304
+
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Vary', 'Accept-Encoding')
+        if status == 304:
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = artifact.gzipped if gzipped else artifact.body
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', artifact.content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        path = urllib.parse.unquote(url.path)
+        try:
+            if path.startswith('/data/'):
+                artifact = self.store.artifact(path[len('/data/'):])
+            elif path.startswith('/query/'):
+                params = urllib.parse.parse_qs(url.query)
+                columns = params.get('columns', [''])[0]
+                artifact = self.store.query(
+                    path[len('/query/'):],
+                    prefecture=params.get('prefecture', [None])[0],
+                    start=params.get('from', [None])[0],
+                    end=params.get('to', [None])[0],
+                    columns=[column for column in columns.split(',') if column],
+                )
+            else:
+                artifact = None
+        except ValueError as e:
+            self._send(400, message=str(e))
+            return
+
+        if artifact is None:
+            self._send(404, message=f'Not found: {path}')
+        else:
+            self._send(200, artifact)
+
+    do_HEAD = do_GET
+
+
+def refresh_periodically(store, interval):
+    while True:
+        time.sleep(interval)
+        store.load()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Serve the latest dataset outputs over HTTP for local development.')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--refresh', type=int, default=DEFAULT_REFRESH, help='seconds between reloads, 0 to disable')
+    parser.add_argument('--only', nargs='+', metavar='PATTERN', help='only serve the datasets matching these glob patterns')
+    options = parser.parse_args(args)
+
+    store = DataStore(functools.partial(update_data.detailed_datasets, options.only))
+    store.load()
+    if options.refresh > 0:
+        threading.Thread(target=refresh_periodically, args=(store, options.refresh), daemon=True).start()
+
+    DataRequestHandler.store = store
+    server = http.server.ThreadingHTTPServer((options.host, options.port), DataRequestHandler)
+    print(f'Serving on http://{options.host}:{options.port}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
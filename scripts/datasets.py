@@ -1,17 +1,74 @@
+import concurrent.futures
+import csv
 import datetime
+import functools
+import glob
+import hashlib
+import inspect
+import io
+import itertools
 import json
-import urllib.request
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import re
+import tempfile
+import threading
 
+import numpy as np
 import pandas as pd
 import tabula
 
+try:
+    import ijson
+except ImportError:  # Streaming JSON parsing is optional
+    ijson = None
+try:
+    import pyarrow as pa
+except ImportError:  # Stage cache is optional
+    pa = None
+
+import fetcher
 import localization
+import memory
 
 
 QUERY_HEADERS = {
     'User-Agent': 'Mozilla/5.0',
 }
 FIREBASE_BATCH_SIZE = 499  # Max = 500
+SHARD_BY_MONTH = 'month'
+SHARD_BY_PREFECTURE = 'prefecture'
+SHARD_UNKNOWN_KEY = 'unknown'
+CACHE_DIR = os.environ.get('COVID_CACHE_DIR', '.cache')
+SCHEDULER = fetcher.FetchScheduler(os.path.join(CACHE_DIR, 'sources'))
+CACHE_STAGES = os.environ.get('COVID_CACHE_STAGES') == '1'
+
+SNIFF_BYTES = 64 * 1024
+PARTITION_ROWS = int(os.environ.get('COVID_PARTITION_ROWS', 200000))
+SPILL_DIR = os.path.join(CACHE_DIR, 'spill')
+SPILL_SAMPLE_ROWS = 10000
+SPILL_CHUNKS_PER_BUDGET = 8  # Raw chunks of a spilled dataset take 1/8 of its memory budget
+
+STAGE_RAW = 'raw'
+STAGE_LOCALIZED = 'localized'
+STAGE_CLEANSED = 'cleansed'
+STAGES = (STAGE_RAW, STAGE_LOCALIZED, STAGE_CLEANSED)
+
+# Source date formats
+DATE_ISO = 'iso'  # '2020-04-12', '2020-04-12T08:00:00.000Z'
+DATE_EPOCH_MS = 'epoch_ms'  # 1586649600000
+DATE_JP_MONTH_DAY = 'jp_month_day'  # '4月12日'
+DEFAULT_DATE_YEAR = 2020  # Year of dates published without one
+# Output format rendering 'M/D' without zero padding
+OUTPUT_MONTH_DAY = 'month_day'
+EPOCH = np.datetime64('1970-01-01', 'D')
+
+LANGUAGE_VI = 'vi'
+LANGUAGE_JA = 'ja'
+LANGUAGE_EN = 'en'
+DEFAULT_LANGUAGE = LANGUAGE_VI  # Written to the unsuffixed files
+LANGUAGES = tuple(os.environ.get('COVID_LANGUAGES', DEFAULT_LANGUAGE).split(','))
 
 
 def batch_data(iterable, n=1):
@@ -21,21 +78,771 @@ def batch_data(iterable, n=1):
         yield iterable[ndx:min(ndx + n, l)]
 
 
+def digest(*parts):
+    """Compute the SHA-1 hex digest of several str/bytes parts."""
+    sha1 = hashlib.sha1()
+    for part in parts:
+        sha1.update(part if isinstance(part, bytes) else str(part).encode())
+        sha1.update(b'\0')
+    return sha1.hexdigest()
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """Compute the SHA-1 hex digest of a local file."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def compile_rewrites(rules):
+    """Compile ordered (pattern, replacement) rules into one alternation regex.
+
+    At each position the first rule that matches wins, and the whole value
+    is rewritten in a single scan.
+
+    returns
+        function rewriting a single string
+    """
+    parts = []
+    replacements = {}
+    for i, (pattern, replacement) in enumerate(rules):
+        regex = pattern.pattern if isinstance(pattern, re.Pattern) else re.escape(pattern)
+        parts.append(f'(?P<r{i}>{regex})')
+        replacements[f'r{i}'] = replacement
+
+    combined = re.compile('|'.join(parts))
+    return functools.partial(combined.sub, lambda match: replacements[match.lastgroup])
+
+
+def _parse_iso(values):
+    dates = pd.to_datetime(pd.Series(values, dtype=object), errors='coerce', utc=True)
+    return dates.dt.tz_localize(None)
+
+
+def _parse_epoch_ms(values):
+    return pd.to_datetime(pd.to_numeric(pd.Series(values, dtype=object), errors='coerce'), unit='ms')
+
+
+def _parse_jp_month_day(values, year):
+    parts = pd.Series(values, dtype=object).astype(str).str.extract(r'([0-9]+)月([0-9]+)日').astype(float)
+    parts.columns = ['month', 'day']
+    parts['year'] = year
+    return pd.to_datetime(parts[['year', 'month', 'day']], errors='coerce')
+
+
+@functools.lru_cache(maxsize=None)
+def date_parser(fmt, year=DEFAULT_DATE_YEAR):
+    """
+    returns
+        function parsing an array of unique raw values into a datetime64 Series
+    """
+    if fmt == DATE_ISO:
+        return _parse_iso
+    if fmt == DATE_EPOCH_MS:
+        return _parse_epoch_ms
+    if fmt == DATE_JP_MONTH_DAY:
+        return functools.partial(_parse_jp_month_day, year=year)
+    raise ValueError(f'Unknown date format "{fmt}"')
+
+
+def parse_dates(series, fmt, year=DEFAULT_DATE_YEAR):
+    """Parse a column of raw dates, each distinct value only once.
+
+    returns
+        datetime64 Series, NaT where the value could not be parsed
+    """
+    codes, uniques = pd.factorize(series)
+    parsed = date_parser(fmt, year)(uniques).to_numpy(dtype='datetime64[ns]')
+    # Missing values have code -1, which picks the appended NaT
+    parsed = np.append(parsed, np.datetime64('NaT', 'ns'))
+    return pd.Series(parsed[codes], index=series.index, name=series.name)
+
+
+def format_dates(series, fmt, na_value=None):
+    """Render a datetime64 column, formatting each distinct date only once."""
+    codes, uniques = pd.factorize(series)
+    uniques = pd.DatetimeIndex(uniques)
+    if fmt == OUTPUT_MONTH_DAY:
+        formatted = uniques.month.astype(str) + '/' + uniques.day.astype(str)
+    else:
+        formatted = uniques.strftime(fmt)
+    formatted = np.append(np.asarray(formatted, dtype=object), na_value)
+    return pd.Series(formatted[codes], index=series.index, name=series.name)
+
+
+def day_numbers(series):
+    """Days since 1970-01-01 as int32, -1 for missing dates."""
+    days = series.to_numpy(dtype='datetime64[D]')
+    numbers = (days - EPOCH).astype(np.int64)
+    numbers[np.isnat(days)] = -1
+    return numbers.astype(np.int32)
+
+
+def english_place_name(name):
+    """English name of a place from its Vietnamese name in the *_CITIES tables."""
+    if ', TP ' in name:
+        district, city = name.split(', TP ', 1)
+        return f'{district}, {city} City'
+    for prefix, fmt in localization.PLACE_NAME_PREFIXES:
+        if name.startswith(prefix):
+            return fmt.format(name[len(prefix):])
+    return name
+
+
+def place_labels(localization_dict):
+    """Labels of places coded by their Japanese name."""
+    return {
+        key: {LANGUAGE_VI: value, LANGUAGE_JA: key, LANGUAGE_EN: english_place_name(value)}
+        for key, value in localization_dict.items()
+    }
+
+
+def apply_labels(series, labels, language):
+    """Render a categorical column of codes in a language, translating each category once."""
+    categories = series.cat.categories
+    # Missing values have code -1, which picks the trailing None
+    names = np.empty(len(categories) + 1, dtype=object)
+    names[:-1] = [labels.get(code, {}).get(language, code) for code in categories]
+    return pd.Series(names[series.cat.codes.to_numpy()], index=series.index, name=series.name)
+
+
+def null_missing(dataframe):
+    """Replace missing values and infinite floats with None.
+
+    where() alone keeps NaN in float columns, which cannot hold None.
+    """
+    data = dataframe.where(dataframe.notnull(), None)
+    for column, dtype in dataframe.dtypes.items():
+        if pd.api.types.is_float_dtype(dtype):
+            values = dataframe[column]
+            data[column] = values.astype(object).where(np.isfinite(values), None)
+    return data
+
+
+class SchemaError(Exception):
+    pass
+
+
+def resolve_json_path(data, path):
+    """Follow a dotted key path such as 'patients.data' into parsed JSON."""
+    for key in path.split('.'):
+        if not isinstance(data, dict) or key not in data:
+            raise KeyError(path)
+        data = data[key]
+    return data
+
+
+def schema_diff(expected, sniffed):
+    """Describe how a sniffed schema differs from the declared one.
+
+    returns
+        list of human readable differences, empty when the schema matches
+    """
+    diff = []
+    missing_keys = [key for key in expected.get('keys', []) if key not in sniffed.get('keys', [])]
+    if missing_keys:
+        diff.append(f'missing keys: {missing_keys}')
+
+    columns = expected.get('columns')
+    actual = sniffed.get('columns')
+    if columns is None or actual is None:
+        return diff
+
+    if isinstance(columns, int):
+        if len(actual) != columns:
+            diff.append(f'expected {columns} columns, got {len(actual)}: {actual}')
+    elif expected.get('ordered', True):
+        if len(actual) != len(columns):
+            diff.append(f'expected {len(columns)} columns, got {len(actual)}')
+        for i, (want, got) in enumerate(zip(columns, actual)):
+            if want != got:
+                diff.append(f'column {i}: expected {want!r}, got {got!r}')
+    else:
+        missing = [column for column in columns if column not in actual]
+        if missing:
+            diff.append(f'missing columns: {missing}')
+
+    return diff
+
+
+def stage_cache_path(name, stage, key='*', cache_dir=None):
+    return os.path.join(cache_dir or CACHE_DIR, 'stages', name, f'{stage}-{key}.arrow')
+
+
+def read_stage(path):
+    """Memory-map an Arrow IPC file written by the stage cache back into a Dataframe."""
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).read_all().to_pandas()
+
+
+def write_frame_file(table, path):
+    with pa.OSFile(path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def _common_type(types):
+    """Type of a column read as different types in different tables, see unify_tables()."""
+    if all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in types):
+        return pa.float64() if any(pa.types.is_floating(t) for t in types) else pa.int64()
+    if all(pa.types.is_dictionary(t) for t in types):
+        # Categoricals get wider indices as their categories grow
+        return pa.dictionary(pa.int32(), _common_type({t.value_type for t in types}))
+    if any(pa.types.is_string(t) or pa.types.is_large_string(t) for t in types):
+        # As a parse of the whole source reads a column with any text in it
+        return pa.string()
+    return next(iter(types))
+
+
+def unify_tables(tables):
+    """Cast tables whose columns drifted, e.g. parsed chunk by chunk, to a common schema.
+
+    Columns missing from a table are filled with nulls and columns only
+    holding nulls take the type of the other tables, numbers are widened
+    and columns mixing numbers and text become text.
+    """
+    names = list(dict.fromkeys(name for table in tables for name in table.column_names))
+    fields = []
+    for name in names:
+        columns = [table.column(name) for table in tables if name in table.column_names]
+        types = {column.type for column in columns if column.null_count < len(column)}
+        types = types or {columns[0].type}
+        fields.append(pa.field(name, next(iter(types)) if len(types) == 1 else _common_type(types)))
+    # The pandas metadata of the table holding the most columns
+    metadata = max(tables, key=lambda table: table.num_columns).schema.metadata
+    schema = pa.schema(fields, metadata=metadata)
+
+    unified = []
+    for table in tables:
+        if table.schema.remove_metadata().equals(schema.remove_metadata()):
+            unified.append(table.replace_schema_metadata(metadata))
+            continue
+        arrays = [
+            table.column(field.name).cast(field.type) if field.name in table.column_names
+            else pa.nulls(table.num_rows, field.type)
+            for field in schema
+        ]
+        unified.append(pa.Table.from_arrays(arrays, schema=schema))
+    return unified
+
+
+def read_frame_files(paths):
+    """Memory-map Arrow IPC files and convert their rows into a single Dataframe at once."""
+    tables = []
+    for path in paths:
+        with pa.memory_map(path) as source:
+            tables.append(pa.ipc.open_file(source).read_all())
+    return pa.concat_tables(unify_tables(tables)).to_pandas()
+
+
+def read_stage_labels(path):
+    """Labels of the encoded columns saved with a stage, see Dataset._encode()."""
+    with pa.memory_map(path) as source:
+        metadata = pa.ipc.open_file(source).schema.metadata or {}
+    return json.loads(metadata.get(b'labels', b'{}'))
+
+
+def load_cached_stage(name, stage=STAGE_CLEANSED, cache_dir=None):
+    """Load the latest cached output of a dataset stage, e.g. from a notebook."""
+    paths = glob.glob(stage_cache_path(name, stage, cache_dir=cache_dir))
+    if not paths:
+        return None
+    return read_stage(max(paths, key=os.path.getmtime))
+
+
+def _write_stream(table, sink):
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def _read_stream(buf, size):
+    with pa.ipc.open_stream(pa.py_buffer(buf)[:size]) as reader:
+        # Copy so that no column still points into the shared memory block
+        return reader.read_pandas().copy()
+
+
+def write_shared_frame(dataframe):
+    """Serialize a Dataframe as an Arrow IPC stream into a new shared memory block.
+
+    Raises pa.ArrowException when a column cannot be converted, e.g. an
+    object column mixing strings and numbers.
+
+    returns
+        (block name, stream size)
+    """
+    table = pa.Table.from_pandas(dataframe, preserve_index=True)
+    mock = pa.MockOutputStream()
+    _write_stream(table, mock)
+    size = mock.size()
+
+    block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    try:
+        _write_stream(table, pa.FixedSizeBufferWriter(pa.py_buffer(block.buf)))
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+    block.close()
+    return block.name, size
+
+
+def read_shared_frame(name, size, unlink=False):
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        dataframe = _read_stream(block.buf, size)
+    finally:
+        block.close()
+        if unlink:
+            block.unlink()
+    return dataframe
+
+
+def unlink_shared_frame(name):
+    """Free a shared memory block nobody is going to read, if it still exists."""
+    try:
+        block = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    block.close()
+    block.unlink()
+
+
+def share_frames(frames):
+    """Write Dataframes to shared memory, all or none of them.
+
+    returns
+        [(block name, stream size), ...], or None when a Dataframe cannot be
+        converted to Arrow
+    """
+    shared = []
+    try:
+        for frame in frames:
+            shared.append(write_shared_frame(frame))
+    except pa.ArrowException as e:
+        for name, _ in shared:
+            unlink_shared_frame(name)
+        print(f'Cannot convert to Arrow, falling back to pickle: {e}')
+        return None
+    return shared
+
+
+def partition_context():
+    """Start workers from a clean process rather than forking, as the pipeline
+    runs steps in threads while others may hold locks, e.g. of urllib or
+    logging, that a forked child would never see released.
+    """
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return multiprocessing.get_context(method)
+
+
+def _run_partition(cls, state, method, partition):
+    """Run a localize/cleanse step on one row range in a worker process.
+
+    The partition and the result are either a Dataframe or the (block name,
+    stream size) of an Arrow stream in shared memory.
+    """
+    dataset = cls.__new__(cls)
+    dataset.__dict__.update(state)
+    if isinstance(partition, tuple):
+        partition = read_shared_frame(*partition, unlink=True)
+    dataset.dataframe = partition
+    getattr(dataset, method)()
+    if pa is None:
+        return dataset.dataframe, dataset.labels
+
+    shared = share_frames([dataset.dataframe])
+    return (dataset.dataframe if shared is None else shared[0]), dataset.labels
+
+
 class Dataset(object):
-    def __init__(self, url, name, **kwargs):
+    # Declared source layout checked before the full parse, e.g.
+    # {'columns': ['No', ...]}, {'columns': 8} or {'keys': ['patients.data']}
+    SCHEMA = None
+    SHARD_DATE_COLUMN = None
+    SHARD_PREFECTURE_COLUMN = None
+    # Set to True when _localize/_cleanse only work row by row, so that
+    # row ranges can be processed independently
+    PARTITIONABLE = False
+    # {column: (output format, value of missing dates)}, the value may be
+    # {language: value}. Date columns are kept as datetime64 and only
+    # rendered by to_dict()
+    DATE_OUTPUT_FORMATS = {}
+
+    def __init__(
+        self,
+        url,
+        name,
+        shard_by=None,
+        cache_stages=None,
+        partition_rows=PARTITION_ROWS,
+        max_workers=None,
+        languages=None,
+        memory_budget=None,
+        **kwargs
+    ):
+        """
+        shard_by
+            None to upload a single file, SHARD_BY_MONTH, SHARD_BY_PREFECTURE
+            or the name of any column to split the output by its values.
+        cache_stages
+            Persist the raw, localized and cleansed Dataframes as Arrow IPC
+            files and reuse them while the source and code are unchanged.
+            Defaults to the COVID_CACHE_STAGES environment variable.
+        partition_rows
+            Minimum number of rows before _localize/_cleanse of a
+            PARTITIONABLE dataset are split across max_workers processes.
+        languages
+            Languages of the output files, DEFAULT_LANGUAGE and ja/en.
+            Defaults to the COVID_LANGUAGES environment variable.
+        memory_budget
+            Bytes of memory the raw Dataframe may take. Past it, the source
+            of a PARTITIONABLE dataset is parsed and processed chunk by
+            chunk through temporary files. Defaults to the
+            COVID_MEMORY_BUDGET environment variable in MB, 0 for no budget.
+        """
         self.url = url
         self.name = name
         self.dataframe = None
+        self.source = None
+        self._source_digest = None
+        self.shard_by = shard_by
+        self.cache_stages = CACHE_STAGES if cache_stages is None else cache_stages
+        self.partition_rows = partition_rows
+        self.max_workers = max_workers or os.cpu_count()
+        self.languages = languages or LANGUAGES
+        # {column: {code: {language: label}}} of the encoded columns
+        self.labels = {}
+        self.memory_budget = memory.MEMORY_BUDGET if memory_budget is None else memory_budget
+        self.spilled = False
+        # Datasets passed to the constructor, see registry.build()
+        self.dependencies = []
+        # This dataset and its dependents not freed yet
+        self.holders = 1
         self.kwargs = kwargs
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
 
     def query_all(self):
-        if self.dataframe is None:
-            self.dataframe = self._create_dataframe()
-            self._localize()
-            self._cleanse()
+        with self._lock:
+            if self.dataframe is None:
+                self.check_schema()
+                if self.cache_stages and pa is not None:
+                    self._query_all_cached()
+                else:
+                    chunk_rows = self._spill_chunk_rows()
+                    if chunk_rows:
+                        self._query_all_spilled(chunk_rows)
+                    else:
+                        self.dataframe = self._create_dataframe()
+                        self._run_step('_localize')
+                        self._run_step('_cleanse')
+
+        return self.dataframe
+
+    def retain(self):
+        """Keep the frames of the dataset until one more release(), e.g. of a dependent dataset."""
+        with self._lock:
+            self.holders += 1
+
+    def release(self):
+        """Called once the dataset is done with, e.g. uploaded, and by each dependent once freed.
+
+        The frames are freed when neither the dataset nor its dependents
+        need them any more, which in turn releases the datasets it depends on.
+        """
+        with self._lock:
+            self.holders -= 1
+            if self.holders > 0:
+                return
+            self.free()
+        for dependency in self.dependencies:
+            dependency.release()
+
+    def free(self):
+        self.dataframe = None
+        self.source = None
+        self._source_digest = None
+
+    def _run_step(self, method):
+        if self.PARTITIONABLE and self.max_workers > 1 and len(self.dataframe) >= self.partition_rows:
+            return self._run_partitioned(method)
+        return getattr(self, method)()
 
+    def _restore_categories(self):
+        # Partitions encoded their columns with different categories
+        for column in self.labels:
+            if column in self.dataframe and not isinstance(self.dataframe[column].dtype, pd.CategoricalDtype):
+                self.dataframe[column] = self.dataframe[column].astype('category')
         return self.dataframe
 
+    def _read_chunks(self, chunk_rows):
+        """Parse the source into Dataframes of chunk_rows rows, or return None if it can only be parsed whole."""
+        return None
+
+    def _estimate_rows(self, sample):
+        """Estimated number of rows of the source, given a Dataframe of its first rows."""
+        return len(sample)
+
+    def _spill_chunk_rows(self):
+        """Size the chunks of a dataset whose raw Dataframe would exceed the memory budget.
+
+        The size of the whole raw Dataframe is projected from a parse of the
+        first SPILL_SAMPLE_ROWS rows.
+
+        returns
+            rows per chunk, or None to parse the source whole
+        """
+        if not self.PARTITIONABLE or not self.memory_budget or pa is None:
+            return None
+        chunks = self._read_chunks(SPILL_SAMPLE_ROWS)
+        sample = None if chunks is None else next(iter(chunks), None)
+        if sample is None or len(sample) < SPILL_SAMPLE_ROWS:
+            return None
+
+        row_bytes = max(memory.frame_bytes(sample) / len(sample), 1)
+        projected = row_bytes * self._estimate_rows(sample)
+        if projected <= self.memory_budget:
+            return None
+        chunk_rows = max(int(self.memory_budget / SPILL_CHUNKS_PER_BUDGET / row_bytes), 1)
+        print(
+            f'{self.name} would take about {projected / memory.MB:.0f} MB, over its memory budget of '
+            f'{self.memory_budget / memory.MB:.0f} MB: processing it in chunks of {chunk_rows} rows'
+        )
+        return chunk_rows
+
+    def _query_all_spilled(self, chunk_rows):
+        """Parse, localize and cleanse the source chunk by chunk through temporary Arrow IPC files.
+
+        Only one raw chunk is in memory at a time, and the raw Dataframe,
+        often several times the size of the cleansed one, is never built.
+        """
+        self.spilled = True
+        os.makedirs(SPILL_DIR, exist_ok=True)
+        with tempfile.TemporaryDirectory(prefix=f'{self.name}-', dir=SPILL_DIR) as directory:
+            paths = []
+            for chunk in self._read_chunks(chunk_rows):
+                self.dataframe = chunk
+                self._localize()
+                self._cleanse()
+                paths.append(os.path.join(directory, f'{len(paths)}.arrow'))
+                write_frame_file(pa.Table.from_pandas(self.dataframe, preserve_index=True), paths[-1])
+                self.dataframe = None
+
+            # Unlike a concat of Dataframes, the chunks are not all in memory twice
+            self.dataframe = read_frame_files(paths)
+            return self._restore_categories()
+
+    def _run_partitioned(self, method):
+        """Split the Dataframe into row ranges and run a step on a process pool.
+
+        Partitions travel through shared memory as Arrow IPC streams rather
+        than being pickled, and are concatenated back in their original order.
+        Partitions that cannot be converted to Arrow are pickled instead.
+        """
+        state = {k: v for k, v in vars(self).items() if k not in ('dataframe', 'source', 'json', 'dependencies', '_lock')}
+        bounds = np.linspace(0, len(self.dataframe), self.max_workers + 1, dtype=int)
+        partitions = [self.dataframe.iloc[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+        if pa is not None:
+            partitions = share_frames(partitions) or partitions
+
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=partition_context()) as executor:
+            futures = [
+                executor.submit(_run_partition, type(self), state, method, partition)
+                for partition in partitions
+            ]
+            concurrent.futures.wait(futures)
+
+        failed = [future for future in futures if future.exception() is not None]
+        if failed:
+            # Free the blocks of the partitions and results nobody is going to read
+            blocks = [partition for partition in partitions if isinstance(partition, tuple)]
+            blocks += [future.result()[0] for future in futures if future not in failed]
+            for block in blocks:
+                if isinstance(block, tuple):
+                    unlink_shared_frame(block[0])
+            raise failed[0].exception()
+
+        frames = []
+        for future in futures:
+            frame, labels = future.result()
+            self.labels.update(labels)
+            frames.append(read_shared_frame(*frame, unlink=True) if isinstance(frame, tuple) else frame)
+        self.dataframe = pd.concat(frames)
+        return self._restore_categories()
+
+    def _fetch_source(self):
+        if os.path.exists(self.url):
+            with open(self.url, 'rb') as f:
+                return f.read()
+
+        return SCHEDULER.fetch(self.url, headers=QUERY_HEADERS)
+
+    def get_source(self):
+        """Raw bytes of the source, fetched once per dataset."""
+        with self._lock:
+            if self.source is None:
+                self.source = self._fetch_source()
+        return self.source
+
+    def source_digest(self):
+        """SHA-1 hex digest of the source, computed once per fetch."""
+        with self._lock:
+            if self._source_digest is None:
+                self._source_digest = hashlib.sha1(self.get_source()).hexdigest()
+        return self._source_digest
+
+    def _source_key(self):
+        """Cheap key of the source, without fetching it.
+
+        returns
+            the source digest once fetched, the size and modification time
+            of a local file, or None when unknown
+        """
+        if self.source is not None:
+            return self.source_digest()
+        if os.path.exists(self.url):
+            stat = os.stat(self.url)
+            return f'{stat.st_size}-{stat.st_mtime_ns}'
+        return None
+
+    def _read_head(self, size=SNIFF_BYTES):
+        """Read only the first bytes of the source, unless it was already fetched."""
+        if self.source is not None:
+            return self.source[:size]
+        if os.path.exists(self.url):
+            with open(self.url, 'rb') as f:
+                return f.read(size)
+
+        return SCHEDULER.fetch(self.url, headers={
+            **QUERY_HEADERS,
+            'Range': f'bytes=0-{size - 1}',
+        }, max_bytes=size)
+
+    def _sniff_schema(self):
+        """Cheaply read the layout of the source, see SCHEMA."""
+        return None
+
+    def check_schema(self):
+        """Abort before the full parse when the source layout no longer matches SCHEMA.
+
+        The validated layout is cached along with a cheap key of the source,
+        so an unchanged source is not even sniffed on later runs.
+        """
+        if self.SCHEMA is None:
+            return
+
+        path = os.path.join(CACHE_DIR, 'schema', f'{self.name}.json')
+        cached = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                cached = json.load(f)
+        source_key = self._source_key()
+        if source_key is not None:
+            source_key = digest(repr(self.SCHEMA), source_key)
+            if cached.get('source') == source_key:
+                return
+
+        sniffed = self._sniff_schema()
+        if sniffed is None:
+            return
+
+        fingerprint = digest(repr(self.SCHEMA), repr(sorted(sniffed.items())))
+        if cached.get('fingerprint') != fingerprint:
+            diff = schema_diff(self.SCHEMA, sniffed)
+            if diff:
+                raise SchemaError(f'Schema of {self.name} changed:\n  ' + '\n  '.join(diff))
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'source': source_key, 'fingerprint': fingerprint}, f)
+
+    def _code_fingerprint(self):
+        modules = {inspect.getsourcefile(cls) for cls in type(self).__mro__ if cls is not object}
+        modules.add(inspect.getsourcefile(localization))
+        return digest(*[file_digest(path) for path in sorted(modules)])
+
+    def _parse_options(self):
+        """
+        returns
+            {option: value} of the options that change the parsed Dataframe,
+            extended by subclasses that keep them as attributes
+        """
+        return dict(self.kwargs)
+
+    def _stage_keys(self):
+        """Cache keys of each stage.
+
+        The raw stage only depends on the source and the parse options, so a
+        change of localization code re-runs localization on the cached parse.
+        """
+        raw_key = digest(type(self).__qualname__, repr(sorted(self._parse_options().items())), self.source_digest())
+        localized_key = digest(raw_key, self._code_fingerprint())
+        cleansed_key = digest(localized_key, STAGE_CLEANSED)
+        return raw_key, localized_key, cleansed_key
+
+    def _load_stage(self, stage, key):
+        path = stage_cache_path(self.name, stage, key)
+        if not os.path.exists(path):
+            return None
+        self.labels = read_stage_labels(path)
+        return read_stage(path)
+
+    def _save_stage(self, stage, key):
+        path = stage_cache_path(self.name, stage, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            table = pa.Table.from_pandas(self.dataframe, preserve_index=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError) as e:
+            print(f'Skipped caching {stage} stage of {self.name}: {e}')
+            return
+
+        metadata = {**(table.schema.metadata or {}), b'labels': json.dumps(self.labels).encode()}
+        table = table.replace_schema_metadata(metadata)
+
+        for stale_path in glob.glob(stage_cache_path(self.name, stage)):
+            os.remove(stale_path)
+        write_frame_file(table, path)
+
+    def _query_all_cached(self):
+        keys = self._stage_keys()
+        steps = (self._create_dataframe, lambda: self._run_step('_localize'), lambda: self._run_step('_cleanse'))
+
+        start = 0
+        for i in reversed(range(len(STAGES))):
+            dataframe = self._load_stage(STAGES[i], keys[i])
+            if dataframe is not None:
+                print(f'Loaded cached {STAGES[i]} stage of {self.name}')
+                self.dataframe = dataframe
+                start = i + 1
+                break
+
+        if start == 0:
+            chunk_rows = self._spill_chunk_rows()
+            if chunk_rows:
+                # Only the cleansed stage exists as a whole
+                self._query_all_spilled(chunk_rows)
+                self._save_stage(STAGE_CLEANSED, keys[-1])
+                return
+
+        for i in range(start, len(STAGES)):
+            if STAGES[i] == STAGE_RAW:
+                self.dataframe = steps[i]()
+            else:
+                steps[i]()
+            self._save_stage(STAGES[i], keys[i])
+
     def _create_dataframe(self):
         raise NotImplementedError()
 
@@ -44,59 +851,81 @@ class Dataset(object):
         self.dataframe.columns = col_list
         return self.dataframe
 
-    def _localize_date(self, column, na_value='Đang điều tra', inplace=True):
-        t = self.dataframe[column].str.extract(r'([0-9]+)月([0-9]+)日')
-        series = t[0] + '/' + t[1]
-        series.fillna(na_value, inplace=True)
+    def _localize_date(self, column, fmt=DATE_JP_MONTH_DAY, inplace=True):
+        series = parse_dates(self.dataframe[column], fmt)
         if inplace:
             self.dataframe[column] = series
 
         return series
 
+    def filter_dates(self, column, start=None, end=None, dataframe=None):
+        """Rows whose date in `column` lies within [start, end]."""
+        if dataframe is None:
+            dataframe = self.dataframe
+        days = day_numbers(dataframe[column])
+        mask = days >= 0
+        if start is not None:
+            mask &= days >= (np.datetime64(start, 'D') - EPOCH).astype(np.int64)
+        if end is not None:
+            mask &= days <= (np.datetime64(end, 'D') - EPOCH).astype(np.int64)
+        return dataframe[mask]
+
+    def _encode(self, column, codes, labels, na_code=None, series=None, inplace=True):
+        """Store a column as categorical language-neutral codes.
+
+        Each distinct raw value is mapped once. Labels are only applied to
+        the categories when rendering the output, see to_dict().
+
+        codes
+            {raw value: code}, other values are kept as their own code
+        labels
+            {code: {language: label}}
+
+        returns
+            the encoded column, or its DEFAULT_LANGUAGE labels when not inplace
+        """
+        if series is None:
+            series = self.dataframe[column]
+        raw_codes, uniques = pd.factorize(series)
+        # Missing values have code -1, which picks the trailing na_code
+        mapped = np.empty(len(uniques) + 1, dtype=object)
+        mapped[:-1] = [codes.get(value, value) for value in uniques]
+        mapped[-1] = na_code
+        encoded = pd.Series(pd.Categorical(mapped[raw_codes]), index=series.index, name=series.name)
+
+        if not inplace:
+            return apply_labels(encoded, labels, DEFAULT_LANGUAGE)
+        self.dataframe[column] = encoded
+        self.labels[column] = labels
+        return encoded
+
+    def label(self, column, value, language=DEFAULT_LANGUAGE):
+        return self.labels.get(column, {}).get(value, {}).get(language, value)
+
+    def _localize_prefecture(self, column, others=None, na_code=None, inplace=True):
+        labels = {**localization.PREFECTURE_LABELS}
+        for key, value in (others or {}).items():
+            if isinstance(value, str):
+                value = {LANGUAGE_VI: value, LANGUAGE_EN: english_place_name(value)}
+            labels[key] = {LANGUAGE_JA: key, **value}
+        return self._encode(column, {}, labels, na_code=na_code, inplace=inplace)
+
     def _localize_age(self, column, na_value='Không rõ', inplace=True):
         series = self.dataframe[column].str.replace('代', 's')
-        series.replace({
-            '1歳未満': 'Dưới 1',
-            '未就学児': 'Dưới 3',
-            '就学児': '3-9',
-            '10歳未': 'Dưới 10',
-            '10歳未満': 'Dưới 10',
-            '90s以上': 'Trên 90',
-            '90歳以上': 'Trên 90',
-            '100歳以': 'Trên 100',
-            '100歳以上': 'Trên 100',
-            '100s以上': 'Trên 100',
-            '不': na_value,
-            '－': na_value,
-            'ー': na_value,
-            '調査中': na_value,
-            '非公表': na_value,
-            '同意なし': na_value,
-            '公表しない': na_value,
-        }, inplace=True)
-        series.fillna(na_value, inplace=True)
-        if inplace:
-            self.dataframe[column] = series
-
-        return series
+        labels = {**localization.AGE_LABELS}
+        labels['unknown'] = {**labels['unknown'], LANGUAGE_VI: na_value}
+        return self._encode(column, localization.AGE_CODES, labels, 'unknown', series=series, inplace=inplace)
 
     def _localize_sex(self, column, na_value='Không công bố', inplace=True):
-        series = self.dataframe[column].replace({
-            '男性': 'Nam',
-            '女性': 'Nữ',
-            '女児': 'Nữ',
-            '調査中': na_value,
-            '－': na_value,
-            '同意なし': na_value,
-            '非公表': na_value,
-            '公表しない': na_value,
-            '不明': na_value,
-        })
-        series.fillna(na_value, inplace=True)
-        if inplace:
-            self.dataframe[column] = series
+        labels = {**localization.SEX_LABELS}
+        labels['unknown'] = {**labels['unknown'], LANGUAGE_VI: na_value}
+        return self._encode(column, localization.SEX_CODES, labels, 'unknown', inplace=inplace)
 
-        return series
+    def _localize_day_of_week(self, column, inplace=True):
+        return self._encode(column, localization.DOW_CODES, localization.DOW_LABELS, inplace=inplace)
+
+    def _localize_status(self, column, inplace=True):
+        return self._encode(column, localization.STATUS_CODES, localization.STATUS_LABELS, inplace=inplace)
 
     def _localize_boolean(self, column, na_value=0, inplace=True):
         series = self.dataframe[column].replace({
@@ -111,6 +940,18 @@ class Dataset(object):
 
         return series
 
+    def _rewrite(self, column, rules, inplace=True):
+        """Apply clean-up rules such as localization.LOCATION_REWRITES once per unique value."""
+        rewrite = compile_rewrites(tuple(tuple(rule) for rule in rules))
+        values = self.dataframe[column].dropna().unique()
+        series = self.dataframe[column].map({
+            value: rewrite(value) for value in values if isinstance(value, str)
+        })
+        if inplace:
+            self.dataframe[column] = series
+
+        return series
+
     def _localize_location(
         self,
         column,
@@ -136,19 +977,24 @@ class Dataset(object):
         outsider_keys += ['県外', '府外', '都外'] + [k + '外' for k in insider_keys]
         na_keys += ['非公表', '調査中']
 
-        series = self.dataframe[column].replace({
-            **localization_dict,
-            **{k: na_value for k in na_keys},
-            **{k: outsider_value for k in outsider_keys},
-            **{k: insider_value for k in insider_keys},
-            **{k: outsider_value for k in localization.PREFECTURES.keys() if k not in insider_keys},
-            **others,
-        })
-        series.fillna(na_value, inplace=True)
-        if inplace:
-            self.dataframe[column] = series
-
-        return series
+        inside = f'{insider_keys[0]}内' if insider_keys and insider_keys[0] else '県内'
+        labels = {
+            **place_labels(localization_dict),
+            **place_labels(others),
+            'inside': {**localization.LOCATION_LABELS['inside'], LANGUAGE_VI: insider_value, LANGUAGE_JA: inside},
+            'outside': {**localization.LOCATION_LABELS['outside'], LANGUAGE_VI: outsider_value},
+            'unknown': {**localization.LOCATION_LABELS['unknown'], LANGUAGE_VI: na_value},
+        }
+        # Later keys win, in the order of the former replace() mapping
+        codes = {
+            **{k: k for k in localization_dict},
+            **{k: 'unknown' for k in na_keys},
+            **{k: 'outside' for k in outsider_keys},
+            **{k: 'inside' for k in insider_keys},
+            **{k: 'outside' for k in localization.PREFECTURES.keys() if k not in insider_keys},
+            **{k: k for k in others},
+        }
+        return self._encode(column, codes, labels, 'unknown', inplace=inplace)
 
     def _localize(self, **kwargs):
         return self.dataframe
@@ -164,32 +1010,161 @@ class Dataset(object):
 
         self.dataframe.to_csv(save_path, index=index)
 
-    def to_dict(self, orient='record', replace_nan=False):
-        data = self.dataframe.where(self.dataframe.notnull(), None) if replace_nan else self.dataframe
+    def to_dict(self, orient='record', replace_nan=False, dataframe=None, language=DEFAULT_LANGUAGE):
+        if dataframe is None:
+            dataframe = self.dataframe
+        if self.DATE_OUTPUT_FORMATS or self.labels:
+            dataframe = dataframe.copy(deep=False)
+            for column, (fmt, na_value) in self.DATE_OUTPUT_FORMATS.items():
+                if isinstance(na_value, dict):
+                    na_value = na_value[language]
+                if column in dataframe and pd.api.types.is_datetime64_any_dtype(dataframe[column]):
+                    dataframe[column] = format_dates(dataframe[column], fmt, na_value)
+            for column, labels in self.labels.items():
+                if column in dataframe and isinstance(dataframe[column].dtype, pd.CategoricalDtype):
+                    dataframe[column] = apply_labels(dataframe[column], labels, language)
+        if language != DEFAULT_LANGUAGE:
+            names = {
+                column: localization.COLUMN_LABELS[column][language]
+                for column in dataframe.columns
+                if language in localization.COLUMN_LABELS.get(column, {})
+            }
+            if names:
+                dataframe = dataframe.rename(columns=names)
+        data = null_missing(dataframe) if replace_nan else dataframe
         return data.to_dict(orient=orient)
 
-    def to_json(self):
-        dict_data = self.to_dict(replace_nan=True)
-        json_data = json.dumps(dict_data)
+    def to_json(self, dataframe=None, language=DEFAULT_LANGUAGE):
+        dict_data = self.to_dict(replace_nan=True, dataframe=dataframe, language=language)
+        # NaN and Infinity are not JSON, fail instead of writing them
+        json_data = json.dumps(dict_data, allow_nan=False)
         return json_data
 
-    def upload_to_storage(self, bucket, extension='json'):
-        """Upload a Dataframe as JSON to Firebase Storage.
+    def _shard_keys(self):
+        if self.shard_by == SHARD_BY_MONTH:
+            dates = self.dataframe[self.SHARD_DATE_COLUMN]
+            if not pd.api.types.is_datetime64_any_dtype(dates):
+                dates = parse_dates(dates, DATE_ISO)
+            keys = format_dates(dates, '%Y-%m')
+        else:
+            column = self.SHARD_PREFECTURE_COLUMN if self.shard_by == SHARD_BY_PREFECTURE else self.shard_by
+            keys = self.dataframe[column]
+            if column in self.labels and isinstance(keys.dtype, pd.CategoricalDtype):
+                # File names are the same in every language
+                keys = apply_labels(keys, self.labels[column], DEFAULT_LANGUAGE)
+
+        keys = keys.fillna(SHARD_UNKNOWN_KEY).astype(str).str.replace('/', '_')
+        # Keep shards out of the way of the index files
+        return keys.mask(keys.str.match(r'index(\.|$)'), '_' + keys)
+
+    def shards(self):
+        """Split the Dataframe by the sharding option.
 
         returns
-            storage_ref
+            {shard_key: Dataframe}
         """
-        storage_ref = f'{self.name}.{extension}'
+        return {key: frame for key, frame in self.dataframe.groupby(self._shard_keys(), sort=True)}
+
+    def _get_shard_index(self, bucket, storage_ref):
         blob = bucket.blob(storage_ref)
+        if not blob.exists():
+            return {}
+        return json.loads(blob.download_as_string())
 
-        if extension == 'json':
-            data_str = self.to_json()
-        else:
+    def _language_suffix(self, language):
+        return '' if language == DEFAULT_LANGUAGE else f'.{language}'
+
+    def _index_ref(self, language, extension='json'):
+        return f'{self.name}/index{self._language_suffix(language)}.{extension}'
+
+    def serialize(self, extension='json'):
+        """Render the Dataframe into the files to upload, once per language.
+
+        DEFAULT_LANGUAGE is written to `<name>.json`, other languages to
+        `<name>.<language>.json`. When sharded, each shard is rendered to
+        `<name>/<key>[.<language>].json` followed by an
+        `<name>/index[.<language>].json` listing row counts and hashes.
+
+        returns
+            [(storage_ref, data_str), ...]
+        """
+        if extension != 'json':
             raise NotImplementedError(f'Unsupported file type "{extension}"')
 
-        blob.upload_from_string(data_str, content_type='application/json')
+        if self.shard_by is None:
+            return [
+                (f'{self.name}{self._language_suffix(language)}.{extension}', self.to_json(language=language))
+                for language in self.languages
+            ]
 
-        return storage_ref
+        payloads = []
+        shards = self.shards()
+        for language in self.languages:
+            suffix = self._language_suffix(language)
+            index = []
+            for key, frame in shards.items():
+                storage_ref = f'{self.name}/{key}{suffix}.{extension}'
+                data_str = self.to_json(frame, language=language)
+                payloads.append((storage_ref, data_str))
+                index.append({
+                    'key': key,
+                    'ref': storage_ref,
+                    'rows': len(frame),
+                    'bytes': len(data_str.encode()),
+                    'sha1': hashlib.sha1(data_str.encode()).hexdigest(),
+                })
+
+            payloads.append((self._index_ref(language, extension), json.dumps({
+                'name': self.name,
+                'shard_by': self.shard_by,
+                'language': language,
+                'shards': index,
+            })))
+        return payloads
+
+    def upload_serialized(self, bucket, payloads):
+        """Upload the output of serialize(), skipping shards unchanged since the last upload.
+
+        returns
+            storage_ref of the first language (of its index file when sharded)
+        """
+        if self.shard_by is None:
+            for storage_ref, data_str in payloads:
+                blob = bucket.blob(storage_ref)
+                blob.upload_from_string(data_str, content_type='application/json')
+            return payloads[0][0]
+
+        # One group of shards followed by their index per language
+        extension = os.path.splitext(payloads[-1][0])[1][1:]
+        index_refs = {self._index_ref(language, extension) for language in self.languages}
+        groups = [[]]
+        for storage_ref, data_str in payloads:
+            groups[-1].append((storage_ref, data_str))
+            if storage_ref in index_refs:
+                groups.append([])
+
+        for group in groups[:-1]:
+            storage_ref, data_str = group[-1]
+            previous = {
+                shard['ref']: shard['sha1']
+                for shard in self._get_shard_index(bucket, storage_ref).get('shards', [])
+            }
+            current = {shard['ref']: shard['sha1'] for shard in json.loads(data_str)['shards']}
+            changed = [(ref, data) for ref, data in group[:-1] if previous.get(ref) != current[ref]]
+            for ref, data in changed + [group[-1]]:
+                blob = bucket.blob(ref)
+                blob.upload_from_string(data, content_type='application/json')
+            print(f'Uploaded {len(changed)}/{len(group) - 1} changed shards of {storage_ref}')
+
+        return groups[0][-1][0]
+
+    def upload_to_storage(self, bucket, extension='json'):
+        """Upload a Dataframe as JSON to Firebase Storage.
+
+        returns
+            storage_ref (of the index file when sharded)
+        """
+        return self.upload_serialized(bucket, self.serialize(extension))
 
     def upload_to_database(self, client, root, item_key=None, batch_size=FIREBASE_BATCH_SIZE):
         if item_key not in self.dataframe.columns:
@@ -211,37 +1186,236 @@ class CsvDataset(Dataset):
         super().__init__(url, name, **kwargs)
 
     def _create_dataframe(self):
-        return pd.read_csv(self.url, **self.kwargs)
+        return pd.read_csv(io.BytesIO(self.get_source()), **self.kwargs)
+
+    def _read_chunks(self, chunk_rows):
+        # Columns are typed per chunk, as read_csv() already does internally
+        # with low_memory=True
+        return pd.read_csv(io.BytesIO(self.get_source()), chunksize=chunk_rows, **self.kwargs)
+
+    def _estimate_rows(self, sample):
+        return self.get_source().count(b'\n')
+
+    def _sniff_schema(self):
+        head = self._read_head().decode(self.kwargs.get('encoding') or 'utf-8-sig', errors='replace')
+        header = next(csv.reader(io.StringIO(head.lstrip('\ufeff'))), [])
+        return {'columns': [column.strip() for column in header]}
 
 
 class ExcelDataset(Dataset):
-    def __init__(self, url, name, sheet_id, header_row=0, **kwargs):
+    def __init__(self, url, name, sheet_id, header_row=0, usecols=None, date_columns=None, streaming=True, **kwargs):
+        """
+        usecols
+            Positions of the columns to keep, all columns when None.
+        date_columns
+            Positions of columns converted to datetime64 while streaming.
+        streaming
+            Read only the requested sheet row by row with openpyxl in
+            read-only mode, instead of loading the whole workbook.
+        """
         super().__init__(url, name, **kwargs)
         self.sheet = sheet_id
         self.header_row = header_row
+        self.usecols = usecols
+        self.date_columns = date_columns or []
+        self.streaming = streaming
+
+    def _parse_options(self):
+        return {
+            **super()._parse_options(),
+            'sheet': self.sheet,
+            'header_row': self.header_row,
+            'usecols': None if self.usecols is None else list(self.usecols),
+            'date_columns': list(self.date_columns),
+            'streaming': self.streaming,
+        }
+
+    def _open_sheet(self):
+        import openpyxl
+
+        workbook = openpyxl.load_workbook(io.BytesIO(self.get_source()), read_only=True, data_only=True)
+        sheet = workbook.worksheets[self.sheet] if isinstance(self.sheet, int) else workbook[self.sheet]
+        return workbook, sheet
 
     def _create_dataframe(self):
-        return pd.read_excel(self.url, self.sheet, header=self.header_row, **self.kwargs)
+        if not self.streaming:
+            return pd.read_excel(
+                io.BytesIO(self.get_source()), self.sheet, header=self.header_row, usecols=self.usecols, **self.kwargs
+            )
+
+        workbook, sheet = self._open_sheet()
+        try:
+            rows = sheet.iter_rows(min_row=self.header_row + 1, values_only=True)
+            header = list(next(rows, ()))
+            while header and header[-1] is None:
+                header.pop()
+            positions = list(range(len(header))) if self.usecols is None else list(self.usecols)
+            buffers = [[] for _ in positions]
+            n_rows = 0
+            for row in rows:
+                if all(value is None for value in row):
+                    continue
+                for buffer, position in zip(buffers, positions):
+                    buffer.append(row[position] if position < len(row) else None)
+                n_rows += 1
+        finally:
+            workbook.close()
+
+        columns = {}
+        for i, (position, buffer) in enumerate(zip(positions, buffers)):
+            if position in self.date_columns:
+                columns[i] = pd.to_datetime(pd.Series(buffer, dtype=object), errors='coerce')
+            else:
+                series = pd.Series(buffer, dtype=object)
+                columns[i] = series.where(series.notnull(), np.nan).infer_objects()
+        dataframe = pd.DataFrame(columns, index=pd.RangeIndex(n_rows))
+        dataframe.columns = [
+            header[position] if position < len(header) and header[position] is not None else f'Unnamed: {position}'
+            for position in positions
+        ]
+        return dataframe
+
+    def _sniff_schema(self):
+        # The whole workbook is needed to locate the sheet, but only its
+        # header row is read
+        workbook, sheet = self._open_sheet()
+        try:
+            row = self.header_row + 1
+            header = list(next(sheet.iter_rows(min_row=row, max_row=row, values_only=True), ()))
+        finally:
+            workbook.close()
+
+        while header and header[-1] is None:
+            header.pop()
+        return {'columns': [str(column).strip() for column in header]}
+
+
+def iter_json_records(data, path):
+    """Walk parsed JSON along a record path such as 'features[].attributes'."""
+    array_path, _, item_path = path.partition('[]')
+    for item in resolve_json_path(data, array_path) if array_path else data:
+        yield resolve_json_path(item, item_path.lstrip('.')) if item_path else item
+
+
+def records_to_columns(records):
+    """Collect records (dicts) into one list per key, padding missing keys with None.
+
+    returns
+        {column: [value, ...]}
+    """
+    columns = {}
+    n_records = 0
+    for record in records:
+        for key, value in record.items():
+            buffer = columns.get(key)
+            if buffer is None:
+                buffer = columns[key] = [None] * n_records
+            elif len(buffer) < n_records:
+                buffer.extend([None] * (n_records - len(buffer)))
+            buffer.append(value)
+        n_records += 1
+
+    for buffer in columns.values():
+        buffer.extend([None] * (n_records - len(buffer)))
+    return columns
 
 
 class JsonDataset(Dataset):
+    # Path to the array of records, e.g. 'features[].attributes' or
+    # 'patients.data[]'. When set, records are parsed incrementally into
+    # column buffers without building the whole JSON tree.
+    RECORD_PATH = None
+
     def __init__(self, url, name, **kwargs):
         super().__init__(url, name, **kwargs)
         self.json = None
 
+    def free(self):
+        super().free()
+        self.json = None
+
+    @property
+    def streaming(self):
+        return self.RECORD_PATH is not None and ijson is not None
+
+    def _parse_options(self):
+        return {**super()._parse_options(), 'record_path': self.RECORD_PATH}
+
     def _get_json_from_url(self):
-        request = urllib.request.Request(self.url, headers=QUERY_HEADERS)
-        with urllib.request.urlopen(request) as url:
-            data = json.loads(url.read().decode())
-        return data
+        return json.loads(self.get_source().decode())
 
     def _create_dataframe(self):
+        if self.streaming:
+            prefix = self.RECORD_PATH.replace('[]', '.item').lstrip('.')
+            records = ijson.items(io.BytesIO(self.get_source()), prefix, use_float=True)
+            return pd.DataFrame(records_to_columns(records))
+
         if self.json is None:
             self.json = self._get_json_from_url()
         return self._create_dataframe_from_json()
 
+    def _read_chunks(self, chunk_rows):
+        if not self.streaming:
+            return None
+        return self._iter_record_chunks(chunk_rows)
+
+    def _iter_record_chunks(self, chunk_rows):
+        prefix = self.RECORD_PATH.replace('[]', '.item').lstrip('.')
+        records = ijson.items(io.BytesIO(self.get_source()), prefix, use_float=True)
+        start = 0
+        while True:
+            columns = records_to_columns(itertools.islice(records, chunk_rows))
+            rows = len(next(iter(columns.values()), []))
+            if not rows:
+                return
+            yield pd.DataFrame(columns, index=pd.RangeIndex(start, start + rows))
+            start += rows
+
+    def _estimate_rows(self, sample):
+        # Assumes the source is serialized about as compactly as to_json()
+        sample_bytes = len(sample.to_json(orient='records').encode())
+        return int(len(self.get_source()) * len(sample) / max(sample_bytes, 1))
+
     def _create_dataframe_from_json(self):
-        raise NotImplementedError()
+        if self.RECORD_PATH is None:
+            raise NotImplementedError()
+        return pd.DataFrame(records_to_columns(iter_json_records(self.json, self.RECORD_PATH)))
+
+    def _sniff_json_keys(self, paths):
+        """Find which key paths exist by scanning parse events, stopping once all are seen."""
+        wanted = set(paths)
+        found = set()
+        for prefix, _, _ in ijson.parse(io.BytesIO(self.get_source())):
+            if prefix in wanted:
+                found.add(prefix)
+                if found == wanted:
+                    break
+        return [path for path in paths if path in found]
+
+    def _sniff_schema(self):
+        paths = self.SCHEMA.get('keys', [])
+        if self.streaming:
+            keys = self._sniff_json_keys(paths)
+        else:
+            if self.json is None:
+                self.json = self._get_json_from_url()
+            keys = []
+            for path in paths:
+                try:
+                    resolve_json_path(self.json, path)
+                    keys.append(path)
+                except KeyError:
+                    pass
+
+        sniffed = {'keys': keys}
+        records = self.SCHEMA.get('records')
+        if records is not None and records in keys:
+            if self.streaming:
+                first = next(ijson.items(io.BytesIO(self.get_source()), f'{records}.item'), {})
+            else:
+                first = next(iter(resolve_json_path(self.json, records)), {})
+            sniffed['columns'] = list(first)
+        return sniffed
 
 
 class PdfDataset(Dataset):
@@ -250,11 +1424,16 @@ class PdfDataset(Dataset):
         self.pages = pages
         self.include_header = include_header
 
+    def _parse_options(self):
+        return {**super()._parse_options(), 'pages': self.pages, 'include_header': self.include_header}
+
     def _create_dataframe(self, **kwargs):
         if self.include_header:
-            df = tabula.read_pdf(self.url, pages=self.pages, **kwargs)
+            df = tabula.read_pdf(io.BytesIO(self.get_source()), pages=self.pages, **kwargs)
         else:
-            df = tabula.read_pdf(self.url, pages=self.pages, pandas_options={'header': None}, **kwargs)
+            df = tabula.read_pdf(
+                io.BytesIO(self.get_source()), pages=self.pages, pandas_options={'header': None}, **kwargs
+            )
 
         if isinstance(df, list):
             df = pd.concat(df)
@@ -0,0 +1,182 @@
+import hashlib
+import os
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+
+CONNECT_TIMEOUT = 10  # Seconds, also bounds each stalled read
+READ_TIMEOUT = 120  # Seconds to download a whole response body
+READ_CHUNK_SIZE = 64 * 1024
+
+FAILURE_THRESHOLD = 3
+COOLDOWN = 600  # Seconds before retrying a host after its circuit opened
+
+# host: (max concurrent requests, requests per second)
+HOST_LIMITS = {
+    'raw.githubusercontent.com': (4, 5.0),
+    'www.mhlw.go.jp': (2, 1.0),
+    'www.pref.saitama.lg.jp': (1, 0.5),
+    'www.pref.kanagawa.jp': (1, 1.0),
+    'services8.arcgis.com': (4, 10.0),
+}
+DEFAULT_HOST_LIMIT = (2, 2.0)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CircuitBreaker(object):
+    """Skip a host for `cooldown` seconds after `threshold` consecutive failures."""
+
+    def __init__(self, threshold=FAILURE_THRESHOLD, cooldown=COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened is None:
+                return True
+            if time.monotonic() - self.opened >= self.cooldown:
+                # Half-open: let one request through, a failure re-opens
+                self.opened = None
+                self.failures = self.threshold - 1
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = time.monotonic()
+
+
+class Host(object):
+    def __init__(self, concurrency, rate):
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.bucket = TokenBucket(rate)
+        self.breaker = CircuitBreaker()
+
+
+class FetchScheduler(object):
+    """Fetch URLs with per-host limits, timeouts and circuit breakers.
+
+    Every successful response is kept in `cache_dir`, and served instead
+    when its host fails or its circuit is open, so that a host that is down
+    neither stalls nor fails the whole run.
+    """
+
+    def __init__(self, cache_dir, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+        self.cache_dir = cache_dir
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+    def _host(self, hostname):
+        with self._lock:
+            if hostname not in self.hosts:
+                self.hosts[hostname] = Host(*HOST_LIMITS.get(hostname, DEFAULT_HOST_LIMIT))
+            return self.hosts[hostname]
+
+    def _cache_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode()).hexdigest())
+
+    def _read_cache(self, url, max_bytes):
+        path = self._cache_path(url)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read(max_bytes) if max_bytes else f.read()
+
+    def _write_cache(self, url, data):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f'{self._cache_path(url)}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self._cache_path(url))
+
+    def _download(self, request, max_bytes):
+        deadline = time.monotonic() + self.read_timeout
+        chunks = []
+        size = 0
+        with urllib.request.urlopen(request, timeout=self.connect_timeout) as response:
+            while max_bytes is None or size < max_bytes:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f'Reading {request.full_url} took more than {self.read_timeout}s')
+                chunk = response.read(READ_CHUNK_SIZE if max_bytes is None else min(READ_CHUNK_SIZE, max_bytes - size))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+        return b''.join(chunks)
+
+    def fetch(self, url, headers=None, max_bytes=None, allow_stale=True):
+        """
+        max_bytes
+            Stop reading after this many bytes. Partial reads are not cached.
+        allow_stale
+            Serve the cached copy when the host fails. When False, e.g. for
+            queries whose answer must be current, failures are raised and
+            the response is not cached.
+
+        returns
+            response body as bytes
+        """
+        host = self._host(urllib.parse.urlparse(url).hostname)
+        if not host.breaker.allow():
+            cached = self._read_cache(url, max_bytes) if allow_stale else None
+            if cached is None:
+                raise CircuitOpenError(f'Skipped {url}: too many failures on its host')
+            print(f'Circuit open, serving cached copy of {url}')
+            return cached
+
+        request = urllib.request.Request(url, headers=headers or {})
+        try:
+            with host.semaphore:
+                host.bucket.acquire()
+                data = self._download(request, max_bytes)
+        except Exception:
+            host.breaker.failure()
+            cached = self._read_cache(url, max_bytes) if allow_stale else None
+            if cached is None:
+                raise
+            print(f'Failed to fetch {url}, serving cached copy')
+            return cached
+
+        host.breaker.success()
+        if max_bytes is None and allow_stale:
+            self._write_cache(url, data)
+        return data
@@ -0,0 +1,110 @@
+import argparse
+import concurrent.futures
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class LoadTest(object):
+    """Request URLs from concurrent workers for a fixed duration.
+
+    With `revalidate`, each worker sends the ETag it last received, as a
+    browser would, so that unchanged artifacts are answered with 304.
+    """
+
+    def __init__(self, urls, concurrency=8, duration=10.0, gzip=True, revalidate=False):
+        self.urls = urls
+        self.concurrency = concurrency
+        self.duration = duration
+        self.gzip = gzip
+        self.revalidate = revalidate
+        self.latencies = []
+        self.statuses = {}
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def _request(self, url, etags):
+        headers = {}
+        if self.gzip:
+            headers['Accept-Encoding'] = 'gzip'
+        if self.revalidate and url in etags:
+            headers['If-None-Match'] = etags[url]
+
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as response:
+                body = response.read()
+                status = response.status
+                etag = response.headers.get('ETag')
+        except urllib.error.HTTPError as e:
+            body = e.read()
+            status = e.code
+            etag = e.headers.get('ETag') if status == 304 else None
+        latency = time.perf_counter() - start
+
+        if etag:
+            etags[url] = etag
+        with self._lock:
+            self.latencies.append(latency)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.bytes += len(body)
+
+    def _worker(self, offset, deadline):
+        etags = {}
+        i = offset
+        while time.perf_counter() < deadline:
+            self._request(self.urls[i % len(self.urls)], etags)
+            i += 1
+
+    def run(self):
+        start = time.perf_counter()
+        deadline = start + self.duration
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for future in [executor.submit(self._worker, i, deadline) for i in range(self.concurrency)]:
+                future.result()
+        self.report(time.perf_counter() - start)
+
+    def report(self, elapsed):
+        latencies = sorted(self.latencies)
+        print(f'{len(latencies)} requests in {elapsed:.2f}s: {len(latencies) / elapsed:.1f} requests/s')
+        if latencies:
+            print(
+                f'latency ms: mean={statistics.mean(latencies) * 1000:.2f} '
+                f'p50={percentile(latencies, 50) * 1000:.2f} '
+                f'p99={percentile(latencies, 99) * 1000:.2f} '
+                f'max={latencies[-1] * 1000:.2f}'
+            )
+        print(f'statuses: {dict(sorted(self.statuses.items()))}, transferred {self.bytes} bytes')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Load test the local data server.')
+    parser.add_argument('urls', nargs='+')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds')
+    parser.add_argument('--no-gzip', action='store_true')
+    parser.add_argument('--revalidate', action='store_true', help='send If-None-Match with the last ETag')
+    options = parser.parse_args(args)
+
+    LoadTest(
+        options.urls,
+        concurrency=options.concurrency,
+        duration=options.duration,
+        gzip=not options.no_gzip,
+        revalidate=options.revalidate,
+    ).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -212,6 +212,20 @@ SAITAMA_CITIES = {
     '行田市': 'Gyoda',
 }
 
+# Ordered (pattern, replacement) clean-up rules applied to raw location values
+# of a prefecture before they are localized. Patterns are literal substrings,
+# or regular expressions when compiled with re.compile. All rules of a
+# prefecture run in a single pass, so a rule never sees another rule's output.
+LOCATION_REWRITES = {
+    '神奈川県': [
+        ('神奈川県', ''),
+        ('内', ''),
+        ('保健所管', ''),
+        ('及び都', ''),
+        ('保健福祉事務所管', '市'),
+    ],
+}
+
 KANAGAWA_CITIES = {
     '相模原市': 'Sagamihara',
     '横浜市': 'Yokohama',
@@ -338,3 +352,185 @@ HYOGO_CITIES = {
     '西宮市': 'Nishinomiya',
     '高砂市': 'Takasago',
 }
+
+# Population estimates as of 1 October 2019, rounded to thousands (Statistics Bureau of Japan)
+PREFECTURE_POPULATION = {
+    '北海道': 5250000,
+    '青森県': 1246000,
+    '岩手県': 1227000,
+    '宮城県': 2306000,
+    '秋田県': 966000,
+    '山形県': 1078000,
+    '福島県': 1846000,
+    '茨城県': 2860000,
+    '栃木県': 1934000,
+    '群馬県': 1942000,
+    '埼玉県': 7350000,
+    '千葉県': 6259000,
+    '東京都': 13921000,
+    '神奈川県': 9198000,
+    '新潟県': 2223000,
+    '富山県': 1044000,
+    '石川県': 1138000,
+    '福井県': 768000,
+    '山梨県': 811000,
+    '長野県': 2049000,
+    '岐阜県': 1987000,
+    '静岡県': 3644000,
+    '愛知県': 7552000,
+    '三重県': 1781000,
+    '滋賀県': 1414000,
+    '京都府': 2583000,
+    '大阪府': 8809000,
+    '兵庫県': 5466000,
+    '奈良県': 1330000,
+    '和歌山県': 925000,
+    '鳥取県': 556000,
+    '島根県': 674000,
+    '岡山県': 1890000,
+    '広島県': 2804000,
+    '山口県': 1358000,
+    '徳島県': 728000,
+    '香川県': 956000,
+    '愛媛県': 1339000,
+    '高知県': 698000,
+    '福岡県': 5104000,
+    '佐賀県': 815000,
+    '長崎県': 1327000,
+    '熊本県': 1748000,
+    '大分県': 1135000,
+    '宮崎県': 1073000,
+    '鹿児島県': 1602000,
+    '沖縄県': 1453000,
+}
+
+# Language-neutral codes of closed vocabularies, and their label in each
+# output language. Raw values missing from the *_CODES tables are kept as
+# their own code, and codes missing from the *_LABELS tables as their label.
+SEX_CODES = {
+    '男性': 'male',
+    '女性': 'female',
+    '女児': 'female',
+    '調査中': 'unknown',
+    '－': 'unknown',
+    '同意なし': 'unknown',
+    '非公表': 'unknown',
+    '公表しない': 'unknown',
+    '不明': 'unknown',
+}
+
+SEX_LABELS = {
+    'male': {'vi': 'Nam', 'ja': '男性', 'en': 'Male'},
+    'female': {'vi': 'Nữ', 'ja': '女性', 'en': 'Female'},
+    'unknown': {'vi': 'Không công bố', 'ja': '非公表', 'en': 'Undisclosed'},
+}
+
+# Keyed by the raw value after '代' was replaced by 's'
+AGE_CODES = {
+    '1歳未満': 'under_1',
+    '未就学児': 'under_3',
+    '就学児': '3-9',
+    '10歳未': 'under_10',
+    '10歳未満': 'under_10',
+    '90s以上': 'over_90',
+    '90歳以上': 'over_90',
+    '100歳以': 'over_100',
+    '100歳以上': 'over_100',
+    '100s以上': 'over_100',
+    '不': 'unknown',
+    '－': 'unknown',
+    'ー': 'unknown',
+    '調査中': 'unknown',
+    '非公表': 'unknown',
+    '同意なし': 'unknown',
+    '公表しない': 'unknown',
+}
+
+AGE_LABELS = {
+    'under_1': {'vi': 'Dưới 1', 'ja': '1歳未満', 'en': 'Under 1'},
+    'under_3': {'vi': 'Dưới 3', 'ja': '未就学児', 'en': 'Preschool'},
+    '3-9': {'vi': '3-9', 'ja': '就学児', 'en': '3-9'},
+    'under_10': {'vi': 'Dưới 10', 'ja': '10歳未満', 'en': 'Under 10'},
+    **{f'{decade}s': {'vi': f'{decade}s', 'ja': f'{decade}代', 'en': f'{decade}s'} for decade in range(10, 100, 10)},
+    'over_90': {'vi': 'Trên 90', 'ja': '90歳以上', 'en': '90 and over'},
+    'over_100': {'vi': 'Trên 100', 'ja': '100歳以上', 'en': '100 and over'},
+    'unknown': {'vi': 'Không rõ', 'ja': '不明', 'en': 'Unknown'},
+}
+
+PREFECTURE_LABELS = {
+    name: {'vi': romaji, 'ja': name, 'en': romaji} for name, romaji in PREFECTURES.items()
+}
+
+LOCATION_LABELS = {
+    'inside': {'vi': 'Trong tỉnh', 'ja': '県内', 'en': 'In the prefecture'},
+    'outside': {'vi': 'Ngoài tỉnh', 'ja': '県外', 'en': 'Outside the prefecture'},
+    'unknown': {'vi': 'Đang điều tra', 'ja': '調査中', 'en': 'Under investigation'},
+}
+
+DOW_CODES = {
+    '日': 'sun',
+    '月': 'mon',
+    '火': 'tue',
+    '水': 'wed',
+    '木': 'thu',
+    '金': 'fri',
+    '土': 'sat',
+}
+
+DOW_LABELS = {
+    'sun': {'vi': 'CN', 'ja': '日', 'en': 'Sun'},
+    'mon': {'vi': '2', 'ja': '月', 'en': 'Mon'},
+    'tue': {'vi': '3', 'ja': '火', 'en': 'Tue'},
+    'wed': {'vi': '4', 'ja': '水', 'en': 'Wed'},
+    'thu': {'vi': '5', 'ja': '木', 'en': 'Thu'},
+    'fri': {'vi': '6', 'ja': '金', 'en': 'Fri'},
+    'sat': {'vi': '7', 'ja': '土', 'en': 'Sat'},
+}
+
+# Vietnamese column names in the other languages. Columns named in English
+# are kept as they are in every language.
+COLUMN_LABELS = {
+    'STT': {'ja': 'No', 'en': 'No'},
+    'Mã vùng': {'ja': '全国地方公共団体コード', 'en': 'Area code'},
+    'Tỉnh/Thành phố': {'ja': '都道府県', 'en': 'Prefecture'},
+    'Quận/Huyện': {'ja': '市区町村', 'en': 'District'},
+    'Ngày công bố': {'ja': '公表日', 'en': 'Published date'},
+    'Thứ': {'ja': '曜日', 'en': 'Day of week'},
+    'Ngày phát hiện triệu chứng': {'ja': '発症日', 'en': 'Symptom date'},
+    'Nơi sinh sống': {'ja': '居住地', 'en': 'Residence'},
+    'Độ tuổi': {'ja': '年代', 'en': 'Age'},
+    'Giới tính': {'ja': '性別', 'en': 'Sex'},
+    'Đặc tính': {'ja': '属性', 'en': 'Attribute'},
+    'Tình trạng': {'ja': '状態', 'en': 'Condition'},
+    'Triệu chứng': {'ja': '症状', 'en': 'Symptom'},
+    'Có lịch sử đi lại hay không': {'ja': '渡航歴の有無', 'en': 'Travel history'},
+    'Tham khảo': {'ja': '備考', 'en': 'Notes'},
+    'Đã ra viện hay chưa': {'ja': '退院済', 'en': 'Discharged'},
+    'Tổng': {'ja': '合計', 'en': 'Total'},
+}
+
+STATUS_CODES = {
+    '退院': 'discharged',
+    '死亡退院': 'died',
+    '入院中': 'hospitalized',
+    '入院調整中': 'awaiting_admission',
+    '管外': 'out_of_jurisdiction',
+}
+
+STATUS_LABELS = {
+    'discharged': {'vi': 'Ra viện', 'ja': '退院', 'en': 'Discharged'},
+    'died': {'vi': 'Tử vong', 'ja': '死亡退院', 'en': 'Died'},
+    'hospitalized': {'vi': 'Đang nằm viện', 'ja': '入院中', 'en': 'Hospitalized'},
+    'awaiting_admission': {'vi': 'Chuẩn bị nhập viện', 'ja': '入院調整中', 'en': 'Awaiting admission'},
+    'out_of_jurisdiction': {'vi': 'Không quản lý', 'ja': '管外', 'en': 'Out of jurisdiction'},
+}
+
+# (Vietnamese prefix, English format) turning the Vietnamese names of the
+# *_CITIES tables into English ones, e.g. 'Thị trấn Mizuho' -> 'Mizuho Town'
+PLACE_NAME_PREFIXES = [
+    ('Thành phố ', '{} City'),
+    ('Thị trấn ', '{} Town'),
+    ('Làng ', '{} Village'),
+    ('Đảo ', '{} Island'),
+    ('Quận ', '{} District'),
+]
@@ -0,0 +1,156 @@
+import json
+import os
+
+import numpy as np
+
+
+MAP_DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'js', 'mapdata', 'jp-all.js')
+# In the units of the Highcharts map coordinates, about 10000 across Japan,
+# i.e. about 16 units per pixel of a 600px wide chart
+SIMPLIFY_TOLERANCE = float(os.environ.get('COVID_MAP_TOLERANCE', 16))
+QUANTUM = int(os.environ.get('COVID_MAP_QUANTUM', 8))
+# Feature properties used by the chart, the others are dropped
+KEPT_PROPERTIES = ('hc-group', 'hc-key', 'hc-middle-x', 'hc-middle-y', 'name')
+# hc-transform fields in map coordinate units, divided by the quantum
+TRANSFORM_SCALED_FIELDS = ('scale', 'xpan', 'ypan', 'jsonmarginX', 'jsonmarginY')
+
+
+def load_highcharts_map(path=MAP_DATA_PATH):
+    """Read the GeoJSON out of a Highcharts map module, e.g. `Highcharts.maps["..."] = {...};`"""
+    with open(path, encoding='utf-8') as f:
+        return parse_highcharts_map(f.read())
+
+
+def parse_highcharts_map(text):
+    return json.loads(text[text.index('=') + 1:].strip().rstrip(';'))
+
+
+def simplify_line(points, tolerance):
+    """Douglas-Peucker simplification of a polyline.
+
+    points
+        N x 2 array
+
+    returns
+        array of the kept points, always including both ends
+    """
+    if len(points) < 3 or tolerance <= 0:
+        return points
+
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = points[first], points[last]
+        segment = end - start
+        inner = points[first + 1:last] - start
+        length = np.hypot(*segment)
+        if length == 0:  # Closed ring, measure from the start point
+            distances = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            distances = np.abs(segment[0] * inner[:, 1] - segment[1] * inner[:, 0]) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            middle = first + 1 + farthest
+            keep[middle] = True
+            stack.append((first, middle))
+            stack.append((middle, last))
+    return points[keep]
+
+
+def quantize(points, quantum):
+    """Snap points to a grid of `quantum` units, in grid units, dropping repeated points."""
+    grid = np.round(points / quantum).astype(np.int64)
+    repeated = np.zeros(len(grid), dtype=bool)
+    repeated[1:] = (grid[1:] == grid[:-1]).all(axis=1)
+    return grid[~repeated]
+
+
+def simplify_ring(ring, tolerance, quantum, closed=True):
+    """
+    returns
+        list of [x, y], or None when the ring collapses
+    """
+    points = quantize(simplify_line(np.asarray(ring, dtype=float), tolerance), quantum)
+    if closed and len(points) < 4:
+        return None
+    if not closed and len(points) < 2:
+        return None
+    return points.tolist()
+
+
+def simplify_polygons(polygons, tolerance, quantum):
+    """Simplify the rings of a MultiPolygon, dropping the rings and islands that collapse.
+
+    The largest polygon is kept even when it collapses, so that no
+    prefecture disappears from the map.
+    """
+    simplified = []
+    for polygon in polygons:
+        rings = [simplify_ring(ring, tolerance, quantum) for ring in polygon]
+        if rings[0] is not None:
+            simplified.append([ring for ring in rings if ring is not None])
+    if not simplified:
+        largest = max(polygons, key=lambda polygon: len(polygon[0]))
+        simplified.append([quantize(np.asarray(largest[0], dtype=float), quantum).tolist()])
+    return simplified
+
+
+def simplify_geometry(geometry, tolerance=SIMPLIFY_TOLERANCE, quantum=QUANTUM):
+    kind = geometry['type']
+    coordinates = geometry['coordinates']
+    if kind == 'Polygon':
+        return {'type': kind, 'coordinates': simplify_polygons([coordinates], tolerance, quantum)[0]}
+    if kind == 'MultiPolygon':
+        polygons = simplify_polygons(coordinates, tolerance, quantum)
+        if len(polygons) == 1:
+            return {'type': 'Polygon', 'coordinates': polygons[0]}
+        return {'type': kind, 'coordinates': polygons}
+    if kind == 'LineString':
+        return {'type': kind, 'coordinates': simplify_ring(coordinates, tolerance, quantum, closed=False) or []}
+    if kind == 'MultiLineString':
+        lines = [simplify_ring(line, tolerance, quantum, closed=False) for line in coordinates]
+        return {'type': kind, 'coordinates': [line for line in lines if line is not None]}
+    raise ValueError(f'Unsupported geometry type "{kind}"')
+
+
+def _scale_transform(transform, quantum):
+    scaled = {key: value / quantum if key in TRANSFORM_SCALED_FIELDS else value for key, value in transform.items()}
+    if 'hitZone' in transform:
+        hit_zone = transform['hitZone']
+        scaled['hitZone'] = {
+            **hit_zone,
+            'coordinates': [[[x / quantum, y / quantum] for x, y in ring] for ring in hit_zone['coordinates']],
+        }
+    return scaled
+
+
+def simplify_map(geojson, tolerance=SIMPLIFY_TOLERANCE, quantum=QUANTUM):
+    """Simplify and quantize the geometry of a Highcharts map.
+
+    Coordinates are divided by `quantum`, and hc-transform is rescaled so
+    that latitude/longitude points still land in place.
+
+    returns
+        GeoJSON FeatureCollection with only the KEPT_PROPERTIES of features
+    """
+    features = []
+    for feature in geojson['features']:
+        features.append({
+            'type': 'Feature',
+            'properties': {key: value for key, value in feature['properties'].items() if key in KEPT_PROPERTIES},
+            'geometry': simplify_geometry(feature['geometry'], tolerance, quantum),
+        })
+
+    simplified = {'type': 'FeatureCollection', 'features': features}
+    for key in ('title', 'copyrightShort', 'copyrightUrl'):
+        if key in geojson:
+            simplified[key] = geojson[key]
+    if 'hc-transform' in geojson:
+        simplified['hc-transform'] = {
+            name: _scale_transform(transform, quantum) for name, transform in geojson['hc-transform'].items()
+        }
+    return simplified
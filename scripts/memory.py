@@ -0,0 +1,110 @@
+import contextlib
+import os
+import resource
+import sys
+import threading
+
+
+MB = 1024 * 1024
+# Per dataset, 0 to disable
+MEMORY_BUDGET = int(float(os.environ.get('COVID_MEMORY_BUDGET', 1024)) * MB)
+SAMPLE_INTERVAL = 0.05  # Seconds
+
+
+def rss():
+    """Resident set size of this process in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Peak rather than current RSS, in kilobytes except on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def frame_bytes(dataframe):
+    if dataframe is None:
+        return 0
+    return int(dataframe.memory_usage(index=True, deep=True).sum())
+
+
+class MemoryMonitor(object):
+    """Sample the RSS of the process while datasets are processed and keep the peak of each one.
+
+    The peak of a dataset is the largest growth of the RSS over its value
+    when one of the dataset's stages started, or the size of its largest
+    Dataframe if that is larger. Stages of different datasets overlap in
+    the pipeline, so the growth may include other datasets, while the
+    Dataframe size only counts the dataset itself.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peaks = {}
+        self.process_peak = 0
+        self.frames = {}
+        self.budgets = {}
+        self.spilled = set()
+        # {name: [RSS at the start of each running stage]}
+        self._active = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='memory-monitor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        value = rss()
+        with self._lock:
+            self.process_peak = max(self.process_peak, value)
+            for name, baselines in self._active.items():
+                self.peaks[name] = max(self.peaks.get(name, 0), value - min(baselines))
+
+    @contextlib.contextmanager
+    def track(self, dataset):
+        name = dataset.name
+        baseline = rss()
+        with self._lock:
+            self._active.setdefault(name, []).append(baseline)
+            self.budgets[name] = dataset.memory_budget
+        try:
+            yield
+        finally:
+            self._sample()
+            size = frame_bytes(dataset.dataframe)
+            with self._lock:
+                self._active[name].remove(baseline)
+                if not self._active[name]:
+                    del self._active[name]
+                self.frames[name] = max(self.frames.get(name, 0), size)
+                self.peaks[name] = max(self.peaks.get(name, 0), size)
+                if dataset.spilled:
+                    self.spilled.add(name)
+
+    def report(self):
+        print(f'Peak RSS of the process: {self.process_peak / MB:.1f} MB')
+        for name, peak in sorted(self.peaks.items(), key=lambda item: -item[1]):
+            budget = self.budgets.get(name)
+            usage = f'{peak / budget:.0%} of {budget / MB:.0f} MB' if budget else 'no budget'
+            notes = []
+            if budget and peak > budget:
+                notes.append('over budget')
+            if name in self.spilled:
+                notes.append('spilled')
+            print(
+                f'{name:<30} peak {peak / MB:8.1f} MB ({usage})  frame {self.frames.get(name, 0) / MB:8.1f} MB'
+                f'{"  " + ", ".join(notes) if notes else ""}'
+            )
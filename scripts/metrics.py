@@ -0,0 +1,135 @@
+import os
+
+import numpy as np
+
+import datasets
+
+
+WINDOW = 7
+PER_POPULATION = 100000
+
+CUMULATIVE = 'cumulative'
+AVERAGE = 'average'
+WEEK_OVER_WEEK = 'week_over_week'
+DOUBLING_DAYS = 'doubling_days'
+CUMULATIVE_RATE = 'cumulative_rate'
+AVERAGE_RATE = 'average_rate'
+METRICS = (CUMULATIVE, AVERAGE, WEEK_OVER_WEEK, DOUBLING_DAYS, CUMULATIVE_RATE, AVERAGE_RATE)
+
+
+def rolling_sum(values, window=WINDOW):
+    """Trailing sum over the last `window` columns of a 2D array."""
+    cumsum = np.cumsum(values, axis=1)
+    result = cumsum.copy()
+    result[:, window:] = cumsum[:, window:] - cumsum[:, :-window]
+    return result
+
+
+def lagged_ratio(numerator, denominator):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = numerator / denominator
+    ratio[~np.isfinite(ratio)] = np.nan
+    return ratio
+
+
+def compute_metrics(daily, population, base=None, window=WINDOW):
+    """Compute all metrics over a prefecture x date matrix of daily cases.
+
+    base
+        Cumulative cases of each prefecture before the first column, so that
+        the matrix can be a trailing slice of the full history.
+
+    returns
+        {metric: prefecture x date array}
+    """
+    daily = np.nan_to_num(daily.astype(float))
+    if base is None:
+        base = np.zeros(len(daily))
+    population = population.astype(float)[:, None]
+
+    cumulative = base[:, None] + np.cumsum(daily, axis=1)
+    weekly = rolling_sum(daily, window)
+
+    previous_weekly = np.full_like(weekly, np.nan)
+    previous_weekly[:, window:] = weekly[:, :-window]
+    previous_cumulative = np.full_like(cumulative, np.nan)
+    previous_cumulative[:, window:] = cumulative[:, :-window]
+
+    growth = lagged_ratio(cumulative, previous_cumulative)
+    growth[growth <= 1] = np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        doubling_days = window * np.log(2) / np.log(growth)
+
+    return {
+        CUMULATIVE: cumulative,
+        AVERAGE: weekly / window,
+        WEEK_OVER_WEEK: lagged_ratio(weekly, previous_weekly),
+        DOUBLING_DAYS: doubling_days,
+        CUMULATIVE_RATE: lagged_ratio(cumulative * PER_POPULATION, population),
+        AVERAGE_RATE: lagged_ratio(weekly / window * PER_POPULATION, population),
+    }
+
+
+class MetricsEngine(object):
+    """Keep metrics of a prefecture x date matrix up to date.
+
+    The previous matrix and its metrics are cached locally. When the new
+    matrix only appends dates to an unchanged history, only the new columns
+    are computed from a trailing slice of 2 windows; otherwise (revised
+    history, new prefectures) everything is recomputed.
+    """
+
+    def __init__(self, name, window=WINDOW, cache_dir=None):
+        self.name = name
+        self.window = window
+        self.path = os.path.join(cache_dir or datasets.CACHE_DIR, 'metrics', f'{name}.npz')
+        self.recomputed_columns = 0
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return None
+        with np.load(self.path, allow_pickle=False) as state:
+            return {key: state[key] for key in state.files}
+
+    def _save(self, prefectures, dates, daily, result):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'wb') as f:
+            np.savez(f, prefectures=np.array(prefectures), dates=np.array(dates), daily=daily, **result)
+
+    def update(self, prefectures, dates, daily, population):
+        """
+        returns
+            {metric: prefecture x date array}
+        """
+        prefectures = [str(p) for p in prefectures]
+        dates = [str(d) for d in dates]
+        daily = np.nan_to_num(np.asarray(daily, dtype=float))
+        state = self._load()
+
+        n_old = 0 if state is None else len(state['dates'])
+        incremental = (
+            state is not None
+            and 0 < n_old <= len(dates)
+            and state['prefectures'].tolist() == prefectures
+            and state['dates'].tolist() == dates[:n_old]
+            and np.array_equal(state['daily'], daily[:, :n_old])
+        )
+
+        if not incremental:
+            result = compute_metrics(daily, population, window=self.window)
+            self.recomputed_columns = len(dates)
+        elif n_old == len(dates):
+            result = {metric: state[metric] for metric in METRICS}
+            self.recomputed_columns = 0
+        else:
+            start = max(0, n_old - 2 * self.window)
+            base = state[CUMULATIVE][:, start - 1] if start > 0 else None
+            tail = compute_metrics(daily[:, start:], population, base=base, window=self.window)
+            result = {
+                metric: np.concatenate([state[metric], tail[metric][:, n_old - start:]], axis=1)
+                for metric in METRICS
+            }
+            self.recomputed_columns = len(dates) - n_old
+
+        self._save(prefectures, dates, daily, result)
+        return result
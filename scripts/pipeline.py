@@ -0,0 +1,360 @@
+import contextlib
+import hashlib
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+import traceback
+
+import pandas as pd
+
+import datasets
+
+
+STAGE_FETCH = 'fetch'
+STAGE_TRANSFORM = 'transform'
+STAGE_SERIALIZE = 'serialize'
+STAGE_UPLOAD = 'upload'
+STAGES = (STAGE_FETCH, STAGE_TRANSFORM, STAGE_SERIALIZE, STAGE_UPLOAD)
+
+RESUME_WINDOW = int(os.environ.get('COVID_RESUME_WINDOW', 3600))  # Seconds
+
+_STOP = object()
+
+
+def _sha1(*parts):
+    return hashlib.sha1(b''.join(parts)).hexdigest()
+
+
+def _frame_fingerprint(dataframe):
+    try:
+        return _sha1(pd.util.hash_pandas_object(dataframe).values.tobytes())
+    except TypeError:  # Unhashable cells such as lists
+        return _sha1(repr(dataframe.shape).encode())
+
+
+def source_fingerprint(dataset):
+    """Digest of the source of a dataset and of the datasets it is derived from, see registry.build()."""
+    if not dataset.dependencies:
+        return dataset.source_digest()
+    return _sha1(*[
+        digest.encode() for digest in
+        [dataset.source_digest()] + [source_fingerprint(dependency) for dependency in dataset.dependencies]
+    ])
+
+
+class RunJournal(object):
+    """Record completed stages of each dataset so that a killed run can resume.
+
+    Serialized payloads are kept in a local spool. A run started within
+    `resume_window` seconds of an unfinished one resumes it: each dataset is
+    fetched again, and when neither its source nor the sources of the
+    datasets it is derived from changed since the recorded fetch, it
+    restarts after its last completed stage. A run that finished
+    with failures only keeps the progress of the failed datasets.
+    """
+
+    def __init__(self, directory=None, resume_window=RESUME_WINDOW):
+        self.directory = directory or os.path.join(datasets.CACHE_DIR, 'journal')
+        self.path = os.path.join(self.directory, 'journal.json')
+        self.resume_window = resume_window
+        self.entries = {}
+        self.started = None
+        self.resumed = False
+        self._lock = threading.Lock()
+
+    def _spool_path(self, name, artifact):
+        return os.path.join(self.directory, 'spool', name, artifact)
+
+    def open(self):
+        previous = None
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                previous = json.load(f)
+
+        if (
+            previous is not None
+            and not previous['complete']
+            and time.time() - previous['started'] < self.resume_window
+        ):
+            self.started = previous['started']
+            self.entries = previous['datasets']
+            self.resumed = True
+            print(f'Resuming run started at {time.ctime(self.started)}')
+        else:
+            self.started = time.time()
+            self.entries = {}
+            shutil.rmtree(os.path.join(self.directory, 'spool'), ignore_errors=True)
+        self._save(complete=False)
+
+    def _save(self, complete):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'started': self.started, 'complete': complete, 'datasets': self.entries}, f)
+        os.replace(tmp_path, self.path)
+
+    def close(self, failed=()):
+        """Finish the run, keeping the progress of the failed datasets for the next run to resume."""
+        with self._lock:
+            for name in list(self.entries):
+                if name not in failed:
+                    del self.entries[name]
+                    shutil.rmtree(os.path.join(self.directory, 'spool', name), ignore_errors=True)
+            self._save(complete=not self.entries)
+
+    def reset(self, name):
+        """Forget the progress of a dataset, e.g. when its source changed."""
+        with self._lock:
+            self.entries.pop(name, None)
+            self._save(complete=False)
+
+    def completed_stage(self, name):
+        """Last completed stage of a dataset in this run, or None."""
+        stages = self.entries.get(name, {})
+        done = [stage for stage in STAGES if stage in stages]
+        return done[-1] if done else None
+
+    def record(self, name, stage, fingerprint):
+        with self._lock:
+            self.entries.setdefault(name, {})[stage] = fingerprint
+            self._save(complete=False)
+
+    def spool_payloads(self, name, payloads):
+        path = self._spool_path(name, 'payloads.json')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(payloads, f)
+        return _sha1(*[data.encode() for _, data in payloads])
+
+    def restore_payloads(self, name):
+        with open(self._spool_path(name, 'payloads.json')) as f:
+            return [tuple(payload) for payload in json.load(f)]
+
+
+class Stage(object):
+    """A pool of worker threads reading from a bounded input queue."""
+
+    def __init__(self, name, func, workers=1, queue_size=2):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.busy_time = 0.0
+        self.processed = 0
+        self.failed = 0
+        self.depth_samples = []
+        self._lock = threading.Lock()
+
+    def put(self, item):
+        # Blocks while the queue is full, which slows down upstream stages
+        self.queue.put(item)
+        with self._lock:
+            self.depth_samples.append(self.queue.qsize())
+
+    def report(self, elapsed):
+        utilization = self.busy_time / (elapsed * self.workers) if elapsed else 0
+        depth = self.depth_samples or [0]
+        print(
+            f'{self.name:<10} workers={self.workers} processed={self.processed} failed={self.failed} '
+            f'utilization={utilization:.0%} queue depth avg={sum(depth) / len(depth):.1f} max={max(depth)}'
+        )
+
+
+class Pipeline(object):
+    """Run datasets through fetch, transform, serialize and upload stages.
+
+    Stages are connected by bounded queues so that e.g. the upload of one
+    dataset overlaps with the fetch of the next one, while a slow stage
+    applies backpressure to the stages before it.
+    """
+
+    def __init__(
+        self,
+        bucket,
+        fetch_workers=4,
+        transform_workers=2,
+        serialize_workers=1,
+        upload_workers=4,
+        queue_size=2,
+        journal=None,
+        profiler=None,
+        bundler=None,
+        memory_monitor=None,
+    ):
+        self.bucket = bucket
+        self.journal = journal
+        self.profiler = profiler
+        self.bundler = bundler
+        self.memory_monitor = memory_monitor
+        self.stages = [
+            Stage(STAGE_FETCH, self._fetch, fetch_workers, queue_size),
+            Stage(STAGE_TRANSFORM, self._transform, transform_workers, queue_size),
+            Stage(STAGE_SERIALIZE, self._serialize, serialize_workers, queue_size),
+            Stage(STAGE_UPLOAD, self._upload, upload_workers, queue_size),
+        ]
+        self.results = {}
+        self.errors = {}
+
+    def _capture(self, dataset, stage):
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.capture(dataset.name, stage)
+
+    def _track(self, dataset):
+        if self.memory_monitor is None:
+            return contextlib.nullcontext()
+        return self.memory_monitor.track(dataset)
+
+    def _done(self, dataset):
+        # Frees the frames of the dataset, and of its dependencies once all
+        # their dependents are done, instead of keeping them until the run ends
+        dataset.release()
+
+    def _fetch(self, item):
+        dataset = item['dataset']
+        # Sniffs the head of the source, so an incompatible source aborts
+        # before it is downloaded in full
+        dataset.check_schema()
+        dataset.get_source()
+        if self.journal is not None:
+            item['fingerprint'] = source_fingerprint(dataset)
+            item['next'] = self._resume(item)
+            self.journal.record(dataset.name, STAGE_FETCH, item['fingerprint'])
+
+    def _transform(self, item):
+        dataset = item['dataset']
+        with self._capture(dataset, STAGE_TRANSFORM):
+            dataset.query_all()
+        if self.journal is not None:
+            self.journal.record(dataset.name, STAGE_TRANSFORM, _frame_fingerprint(dataset.dataframe))
+
+    def _serialize(self, item):
+        dataset = item['dataset']
+        with self._capture(dataset, STAGE_SERIALIZE):
+            item['payloads'] = dataset.serialize()
+        if self.journal is not None:
+            fingerprint = self.journal.spool_payloads(dataset.name, item['payloads'])
+            self.journal.record(dataset.name, STAGE_SERIALIZE, fingerprint)
+
+    def _upload(self, item):
+        dataset = item['dataset']
+        payloads = item.pop('payloads')
+        with self._capture(dataset, STAGE_UPLOAD):
+            self.results[dataset.name] = dataset.upload_serialized(self.bucket, payloads)
+        if self.bundler is not None:
+            self.bundler.add(dataset.name, payloads)
+        if self.journal is not None:
+            self.journal.record(dataset.name, STAGE_UPLOAD, self.results[dataset.name])
+
+    def _resume(self, item):
+        """Restore spooled artifacts of a fetched dataset and return the index of its next stage to run."""
+        dataset = item['dataset']
+        completed = self.journal.completed_stage(dataset.name)
+        if completed is None:
+            return STAGES.index(STAGE_TRANSFORM)
+        if self.journal.entries[dataset.name].get(STAGE_FETCH) != item['fingerprint']:
+            print(f'Dataset {dataset.name}: source or dependencies changed since the resumed run')
+            self.journal.reset(dataset.name)
+            return STAGES.index(STAGE_TRANSFORM)
+
+        if completed == STAGE_UPLOAD:
+            self.results[dataset.name] = self.journal.entries[dataset.name][STAGE_UPLOAD]
+            print(f'Dataset {dataset.name}: already uploaded in this run')
+            if self.bundler is not None:
+                self.bundler.add(dataset.name, self.journal.restore_payloads(dataset.name))
+            return len(self.stages)
+        if completed == STAGE_SERIALIZE:
+            item['payloads'] = self.journal.restore_payloads(dataset.name)
+            return STAGES.index(STAGE_UPLOAD)
+        # The transformed Dataframe is not spooled, but the stage cache
+        # makes re-running the transform cheap
+        return STAGES.index(STAGE_TRANSFORM)
+
+    def _work(self, index):
+        stage = self.stages[index]
+        while True:
+            item = stage.queue.get()
+            if item is _STOP:
+                break
+
+            dataset = item['dataset']
+            start = time.perf_counter()
+            try:
+                with self._track(dataset):
+                    stage.func(item)
+            except Exception as e:
+                with stage._lock:
+                    stage.failed += 1
+                self.errors[dataset.name] = e
+                print(f'Failed to {stage.name} dataset {dataset.name}')
+                traceback.print_exc()
+                self._done(dataset)
+                continue
+            finally:
+                with stage._lock:
+                    stage.busy_time += time.perf_counter() - start
+
+            with stage._lock:
+                stage.processed += 1
+            print(f'Dataset {dataset.name}: {stage.name} done')
+            # Resumed datasets skip the stages completed in the resumed run
+            next_index = item.pop('next', index + 1)
+            if next_index < len(self.stages):
+                self.stages[next_index].put(item)
+            else:
+                self._done(dataset)
+
+    def run(self, all_datasets):
+        """
+        returns
+            {dataset name: storage_ref} of the datasets uploaded successfully
+        """
+        start = time.perf_counter()
+        if self.memory_monitor is not None:
+            self.memory_monitor.start()
+        threads = []
+        for index, stage in enumerate(self.stages):
+            threads.append([
+                threading.Thread(target=self._work, args=(index,), name=f'{stage.name}-{i}', daemon=True)
+                for i in range(stage.workers)
+            ])
+            for thread in threads[-1]:
+                thread.start()
+
+        if self.journal is not None:
+            self.journal.open()
+        for dataset in all_datasets:
+            self.stages[0].put({'dataset': dataset})
+
+        # Drain the stages in order, so that each stage stops only after all
+        # items of the previous one went through
+        for stage, stage_threads in zip(self.stages, threads):
+            for _ in stage_threads:
+                stage.queue.put(_STOP)
+            for thread in stage_threads:
+                thread.join()
+
+        if self.bundler is not None:
+            try:
+                self.bundler.upload(self.bucket)
+            except Exception as e:
+                self.errors['bundles'] = e
+                print('Failed to upload bundles')
+                traceback.print_exc()
+
+        if self.journal is not None:
+            self.journal.close(failed=self.errors)
+        if self.memory_monitor is not None:
+            self.memory_monitor.stop()
+        self.report(time.perf_counter() - start)
+        return self.results
+
+    def report(self, elapsed):
+        print(f'Pipeline finished in {elapsed:.2f}s: {len(self.results)} uploaded, {len(self.errors)} failed')
+        for stage in self.stages:
+            stage.report(elapsed)
+        if self.memory_monitor is not None:
+            self.memory_monitor.report()
@@ -0,0 +1,219 @@
+import argparse
+import collections
+import contextlib
+import cProfile
+import datetime
+import fnmatch
+import os
+import pstats
+import sys
+import threading
+import time
+
+import datasets
+
+
+PROFILE_ENV = 'COVID_PROFILE'  # '1' or '*' for every dataset, or comma-separated name patterns
+PROFILE_MODE_ENV = 'COVID_PROFILE_MODE'
+MODE_SAMPLING = 'sampling'
+MODE_CPROFILE = 'cprofile'
+SAMPLE_INTERVAL = 0.005  # Seconds
+TOP_N = 25
+
+
+def frame_label(module, function):
+    # Module names rather than paths or line numbers, so captures from
+    # different checkouts and runs can be compared
+    return f'{module}:{function}'
+
+
+def _frame_stack(frame):
+    stack = []
+    while frame is not None:
+        stack.append(frame_label(frame.f_globals.get('__name__', '?'), frame.f_code.co_name))
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+
+class Sampler(threading.Thread):
+    """Sample the stack of one thread at a fixed interval."""
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        super().__init__(name=f'sampler-{thread_id}', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[_frame_stack(frame)] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        return self.stacks
+
+
+def _cprofile_stacks(profile):
+    """Approximate collapsed stacks from cProfile's caller -> callee edges.
+
+    cProfile does not record whole stacks, so each entry is a two-frame
+    stack weighted by the time spent in the callee in microseconds.
+    """
+    stacks = collections.Counter()
+    for (filename, _, function), (_, _, tottime, _, callers) in pstats.Stats(profile).stats.items():
+        callee = frame_label(_module_name(filename), function)
+        if not callers:
+            stacks[(callee,)] += int(tottime * 1e6)
+        for (caller_file, _, caller_function), (_, _, edge_tottime, _) in callers.items():
+            caller = frame_label(_module_name(caller_file), caller_function)
+            stacks[(caller, callee)] += int(edge_tottime * 1e6)
+    return stacks
+
+
+def _module_name(filename):
+    if filename == '~':  # Built-in functions
+        return 'builtins'
+    for path in sorted(sys.path, key=len, reverse=True):
+        if path and filename.startswith(path + os.sep):
+            filename = filename[len(path) + 1:]
+            break
+    return os.path.splitext(filename)[0].replace(os.sep, '.')
+
+
+def summarize(stacks, n=TOP_N):
+    """Hottest functions by own samples and by samples including callees.
+
+    returns
+        (total samples, [(function, own, inclusive), ...])
+    """
+    total = sum(stacks.values())
+    own = collections.Counter()
+    inclusive = collections.Counter()
+    for stack, count in stacks.items():
+        own[stack[-1]] += count
+        for function in set(stack):
+            inclusive[function] += count
+
+    top = [(function, own[function], inclusive[function]) for function, _ in own.most_common(n)]
+    return total, top
+
+
+def write_collapsed(path, stacks):
+    """Write stacks in the collapsed format read by flamegraph.pl and speedscope."""
+    with open(path, 'w') as f:
+        for stack, count in sorted(stacks.items()):
+            f.write(f'{";".join(stack)} {count}\n')
+
+
+def read_collapsed(path):
+    stacks = collections.Counter()
+    with open(path) as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            stacks[tuple(stack.split(';'))] += int(count)
+    return stacks
+
+
+class Profiler(object):
+    """Capture profiles of selected datasets, per pipeline stage.
+
+    Each capture writes `<dataset>.<stage>.collapsed` and a top-N summary
+    `<dataset>.<stage>.txt` into a directory per run, so that runs can be
+    compared with `python profiler.py compare <old run> <new run>`.
+    Steps run on worker processes (partitioned steps, clinic parsing) are
+    not sampled.
+    """
+
+    def __init__(self, patterns=None, mode=MODE_SAMPLING, interval=SAMPLE_INTERVAL, output_dir=None):
+        self.patterns = patterns or ['*']
+        self.mode = mode
+        self.interval = interval
+        run = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        self.output_dir = output_dir or os.path.join(datasets.CACHE_DIR, 'profiles', run)
+
+    @classmethod
+    def from_env(cls):
+        """
+        returns
+            Profiler configured from COVID_PROFILE, or None when profiling is off
+        """
+        value = os.environ.get(PROFILE_ENV, '')
+        if not value or value == '0':
+            return None
+        patterns = None if value in ('1', '*') else [p.strip() for p in value.split(',') if p.strip()]
+        return cls(patterns, mode=os.environ.get(PROFILE_MODE_ENV, MODE_SAMPLING))
+
+    def enabled_for(self, name):
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in self.patterns)
+
+    @contextlib.contextmanager
+    def capture(self, name, stage):
+        if not self.enabled_for(name):
+            yield
+            return
+
+        start = time.perf_counter()
+        if self.mode == MODE_CPROFILE:
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                self.write(name, stage, _cprofile_stacks(profile), time.perf_counter() - start, 'us')
+        else:
+            sampler = Sampler(threading.get_ident(), self.interval)
+            sampler.start()
+            try:
+                yield
+            finally:
+                self.write(name, stage, sampler.stop(), time.perf_counter() - start, 'samples')
+
+    def write(self, name, stage, stacks, elapsed, unit):
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(self.output_dir, f'{name}.{stage}')
+        write_collapsed(f'{prefix}.collapsed', stacks)
+
+        total, top = summarize(stacks)
+        with open(f'{prefix}.txt', 'w') as f:
+            f.write(f'{name} {stage}: {elapsed:.3f}s, {total} {unit}, mode={self.mode}, interval={self.interval}s\n')
+            f.write(f'{"own %":>7} {"total %":>7}  function\n')
+            for function, own, inclusive in top:
+                f.write(f'{own / max(total, 1):7.1%} {inclusive / max(total, 1):7.1%}  {function}\n')
+        print(f'Profile of {name} {stage} ({elapsed:.2f}s) written to {prefix}.collapsed')
+
+
+def compare(old_dir, new_dir, n=TOP_N):
+    """Print the change of each hot function's share of samples between two runs."""
+    for path in sorted(os.listdir(new_dir)):
+        if not path.endswith('.collapsed') or not os.path.exists(os.path.join(old_dir, path)):
+            continue
+        old_total, old_top = summarize(read_collapsed(os.path.join(old_dir, path)), n=None)
+        new_total, new_top = summarize(read_collapsed(os.path.join(new_dir, path)), n=n)
+        old_own = {function: own / max(old_total, 1) for function, own, _ in old_top}
+
+        print(f'{path[:-len(".collapsed")]}: {old_total} -> {new_total} samples')
+        for function, own, _ in new_top:
+            share = own / max(new_total, 1)
+            print(f'  {old_own.get(function, 0):7.1%} -> {share:7.1%}  {function}')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Compare profiles captured by two update runs.')
+    parser.add_argument('command', choices=['compare'])
+    parser.add_argument('old_dir')
+    parser.add_argument('new_dir')
+    parser.add_argument('--top', type=int, default=TOP_N)
+    options = parser.parse_args(args)
+
+    compare(options.old_dir, options.new_dir, options.top)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
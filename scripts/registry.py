@@ -0,0 +1,102 @@
+import fnmatch
+
+
+class Entry(object):
+    def __init__(self, cls, depends_on, kwargs):
+        self.cls = cls
+        self.name = cls.NAME
+        self.depends_on = depends_on
+        self.kwargs = kwargs
+
+
+# {dataset name: Entry}, in registration order
+REGISTRY = {}
+
+
+def register(*depends_on, **kwargs):
+    """Class decorator registering a Dataset subclass under its NAME.
+
+    depends_on
+        names of the datasets whose instances are passed positionally to
+        the constructor, e.g. register('prefecture-by-date') for a dataset
+        derived from PrefectureByDateDataset
+
+    kwargs
+        constructor options, e.g. shard_by or encoding
+    """
+    def decorator(cls):
+        if cls.NAME in REGISTRY:
+            raise ValueError(f'Dataset {cls.NAME} is already registered')
+        REGISTRY[cls.NAME] = Entry(cls, depends_on, kwargs)
+        return cls
+    return decorator
+
+
+def select(patterns=None):
+    """
+    returns
+        registered names matching any of the glob patterns, all names if None
+    """
+    if not patterns:
+        return list(REGISTRY)
+    names = [name for name in REGISTRY if any(fnmatch.fnmatchcase(name, p) for p in patterns)]
+    if not names:
+        raise KeyError(f'No registered dataset matches {", ".join(patterns)}')
+    return names
+
+
+def resolve(names):
+    """Add the dependencies of the datasets and sort them so that each one comes after its dependencies.
+
+    returns
+        list of dataset names
+    """
+    order = []
+    visiting = set()
+
+    def visit(name, path):
+        if name in order:
+            return
+        if name not in REGISTRY:
+            raise KeyError(f'Unknown dataset {name} (required by {" -> ".join(path) or "command line"})')
+        if name in visiting:
+            raise ValueError(f'Dependency cycle: {" -> ".join(path + [name])}')
+        visiting.add(name)
+        for dependency in REGISTRY[name].depends_on:
+            visit(dependency, path + [name])
+        visiting.discard(name)
+        order.append(name)
+
+    for name in names:
+        visit(name, [])
+    return order
+
+
+def build(patterns=None):
+    """Instantiate the selected datasets and, once each, the datasets they depend on.
+
+    A dependency is a single instance shared by all its dependents, so its
+    source is fetched and parsed once. Dependents read the frame from
+    query_all() of the shared instance and must not modify it. Its frames
+    are kept until it and all its dependents are released, see
+    Dataset.release().
+
+    returns
+        (selected datasets, {name: dataset} of all instantiated datasets)
+    """
+    selected = select(patterns)
+    instances = {}
+    for name in resolve(selected):
+        entry = REGISTRY[name]
+        dependencies = [instances[dependency] for dependency in entry.depends_on]
+        instances[name] = entry.cls(*dependencies, **entry.kwargs)
+        instances[name].dependencies = dependencies
+        for dependency in dependencies:
+            dependency.retain()
+
+    for name, dataset in instances.items():
+        if name not in selected:
+            # Only built for its dependents, which hold it
+            dataset.holders -= 1
+
+    return [instances[name] for name in instances if name in selected], instances
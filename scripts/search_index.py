@@ -0,0 +1,216 @@
+import hashlib
+import json
+import math
+import os
+import statistics
+import time
+import unicodedata
+
+import datasets
+
+
+NGRAM_SIZE = 2
+SHARD_MAX_BYTES = int(os.environ.get('COVID_SEARCH_SHARD_BYTES', 64 * 1024))
+# Shards start this full on average, hashing leaves some larger than others
+SHARD_FILL = 0.5
+
+
+def normalize(text):
+    """Fold full-width/half-width variants and drop whitespace before indexing."""
+    text = unicodedata.normalize('NFKC', str(text)).lower()
+    return ''.join(text.split())
+
+
+def ngrams(text, n=NGRAM_SIZE):
+    text = normalize(text)
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def gram_hash(gram):
+    """FNV-1a 32-bit hash of the UTF-8 bytes of an n-gram, simple to compute in the browser too."""
+    value = 0x811c9dc5
+    for byte in gram.encode():
+        value = ((value ^ byte) * 0x01000193) & 0xffffffff
+    return value
+
+
+def shard_key(gram, shard_count):
+    return f'{gram_hash(gram) % shard_count:04x}'
+
+
+def _posting_bytes(gram, doc_ids):
+    return len(json.dumps({gram: doc_ids}).encode())
+
+
+class SearchIndex(object):
+    """Character n-gram inverted index split into small static shards.
+
+    Postings of each source (e.g. a prefecture) are cached locally together
+    with the digest of the source, so only changed sources are re-indexed.
+    """
+
+    def __init__(self, name, cache_dir=None):
+        self.name = name
+        self.cache_dir = os.path.join(cache_dir or datasets.CACHE_DIR, 'search', name)
+        self.postings = {}
+        self.reindexed = []
+        self.build_time = 0.0
+
+    def _cache_path(self, source):
+        return os.path.join(self.cache_dir, f'{source}.json')
+
+    def load_cached(self, source, digest):
+        """Load the cached postings of a source if they were built from the same digest.
+
+        returns
+            True if loaded
+        """
+        start = time.perf_counter()
+        path = self._cache_path(source)
+        if not os.path.exists(path):
+            return False
+        with open(path) as f:
+            cached = json.load(f)
+        if cached['digest'] != digest:
+            return False
+        self.postings[source] = cached['postings']
+        self.build_time += time.perf_counter() - start
+        return True
+
+    def update(self, source, digest, documents):
+        """Load cached postings of a source, or rebuild them if its digest changed.
+
+        documents
+            callable returning [(doc_id, [text, ...]), ...], only called
+            when the postings are rebuilt
+        """
+        if self.load_cached(source, digest):
+            return False
+
+        start = time.perf_counter()
+        path = self._cache_path(source)
+        postings = {}
+        for doc_id, texts in documents():
+            grams = set()
+            for text in texts:
+                grams |= ngrams(text)
+            for gram in grams:
+                postings.setdefault(gram, []).append(doc_id)
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'digest': digest, 'postings': postings}, f)
+        self.postings[source] = postings
+        self.reindexed.append(source)
+        self.build_time += time.perf_counter() - start
+        return True
+
+    def shards(self, max_bytes=SHARD_MAX_BYTES):
+        """Merge postings of all sources and split them into shards of at most max_bytes.
+
+        n-grams are spread by gram_hash() modulo the shard count, which is
+        doubled until every shard fits. The postings of an n-gram larger
+        than max_bytes on its own, e.g. a digit pair of postal codes, are
+        split into parts stored in shards of their own.
+
+        returns
+            ({shard_key: {ngram: [doc_id, ...]}}, shard count, {ngram: [shard_key of each part]})
+        """
+        merged = {}
+        for source in sorted(self.postings):
+            for gram, doc_ids in self.postings[source].items():
+                merged.setdefault(gram, []).extend(doc_ids)
+
+        shards = {}
+        split_grams = {}
+        sizes = {}
+        for gram, doc_ids in merged.items():
+            size = _posting_bytes(gram, doc_ids)
+            if size <= max_bytes:
+                sizes[gram] = size
+                continue
+            parts = math.ceil(size / max_bytes)
+            while True:
+                step = math.ceil(len(doc_ids) / parts)
+                chunks = [doc_ids[i:i + step] for i in range(0, len(doc_ids), step)]
+                if all(_posting_bytes(gram, chunk) <= max_bytes for chunk in chunks):
+                    break
+                parts += 1
+            split_grams[gram] = []
+            for i, chunk in enumerate(chunks):
+                key = f'{gram_hash(gram):08x}-{i}'
+                shards[key] = {gram: chunk}
+                split_grams[gram].append(key)
+
+        shard_count = max(1, math.ceil(sum(sizes.values()) / (max_bytes * SHARD_FILL)))
+        while True:
+            totals = {}
+            for gram, size in sizes.items():
+                key = shard_key(gram, shard_count)
+                totals[key] = totals.get(key, 0) + size
+            if max(totals.values(), default=0) <= max_bytes or shard_count >= len(sizes):
+                break
+            shard_count *= 2
+
+        for gram in sizes:
+            shards.setdefault(shard_key(gram, shard_count), {})[gram] = merged[gram]
+        return shards, shard_count, split_grams
+
+    def upload_to_storage(self, bucket):
+        """Upload shards whose content changed since the previous build.
+
+        returns
+            list of uploaded storage refs
+        """
+        start = time.perf_counter()
+        manifest_path = os.path.join(self.cache_dir, 'manifest.json')
+        manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+
+        uploaded = []
+        sizes = {}
+        digests = {}
+        shards, shard_count, split_grams = self.shards()
+        for key, shard in shards.items():
+            data_str = json.dumps(shard, sort_keys=True)
+            storage_ref = f'{self.name}-search/{key}.json'
+            sizes[storage_ref] = len(data_str.encode())
+            digests[storage_ref] = hashlib.sha1(data_str.encode()).hexdigest()
+            if manifest.get(storage_ref) != digests[storage_ref]:
+                blob = bucket.blob(storage_ref)
+                blob.upload_from_string(data_str, content_type='application/json')
+                uploaded.append(storage_ref)
+
+        index_ref = f'{self.name}-search/index.json'
+        bucket.blob(index_ref).upload_from_string(json.dumps({
+            'ngram_size': NGRAM_SIZE,
+            # Shard of an n-gram: '<name>-search/<FNV-1a hash % shard_count, 4 hex digits>.json'
+            'hash': 'fnv1a32',
+            'shard_count': shard_count,
+            'split_grams': split_grams,
+            'shards': sorted(sizes),
+        }), content_type='application/json')
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(manifest_path, 'w') as f:
+            json.dump(digests, f)
+
+        self.report(sizes, uploaded, time.perf_counter() - start)
+        return uploaded
+
+    def report(self, sizes, uploaded, elapsed):
+        print(
+            f'Search index {self.name}: re-indexed {len(self.reindexed)}/{len(self.postings)} sources '
+            f'in {self.build_time:.2f}s'
+        )
+        if sizes:
+            values = sorted(sizes.values())
+            print(
+                f'{len(values)} shards, {len(uploaded)} uploaded in {elapsed:.2f}s, '
+                f'size min/median/max = {values[0]}/{int(statistics.median(values))}/{values[-1]} bytes, '
+                f'total = {sum(values)} bytes'
+            )
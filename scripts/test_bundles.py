@@ -0,0 +1,86 @@
+import hashlib
+import json
+import unittest
+
+import bundles
+
+
+class FakeBlob(object):
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def exists(self):
+        return self.name in self.store
+
+    def upload_from_string(self, data, content_type=None):
+        self.store[self.name] = data
+
+    def download_as_string(self):
+        data = self.store[self.name]
+        return data.encode() if isinstance(data, str) else data
+
+
+class FakeBucket(object):
+    def __init__(self):
+        self.store = {}
+
+    def blob(self, name):
+        return FakeBlob(self.store, name)
+
+
+def _bundle(expected=('patient-all', 'prefecture-metrics')):
+    return bundles.Bundle('detailed', ['*'], expected=expected)
+
+
+class BundleTest(unittest.TestCase):
+    def test_pack_round_trip(self):
+        payloads = {
+            'patient-all.json': '[{"Tỉnh": "東京"}]',
+            'patient-all.en.json': '[{"Prefecture": "Tokyo"}]',
+            'prefecture-metrics.json': '[]',
+        }
+        bucket = FakeBucket()
+        bundle = _bundle()
+        bundle.add_payloads([(ref, data) for ref, data in payloads.items() if ref.startswith('patient')], 'patient-all')
+        bundle.add_payloads([('prefecture-metrics.json', payloads['prefecture-metrics.json'])], 'prefecture-metrics')
+        self.assertEqual(bundle.upload(bucket), 'bundles/detailed.pack')
+
+        members = _bundle().read_pack(bucket)
+        self.assertEqual({ref: data.decode() for ref, data in members.items()}, payloads)
+
+        # Absolute offsets for Range requests of single members
+        pack = bucket.store['bundles/detailed.pack']
+        index = json.loads(bucket.store['bundles/detailed.pack.json'])
+        self.assertEqual(index['size'], len(pack))
+        for ref, member in index['members'].items():
+            data = pack[member['offset']:member['offset'] + member['length']]
+            self.assertEqual(data, payloads[ref].encode())
+            self.assertEqual(member['sha1'], hashlib.sha1(data).hexdigest())
+
+    def test_partial_run_keeps_previous_members(self):
+        bucket = FakeBucket()
+        bundle = _bundle()
+        bundle.add_payloads([('patient-all.json', '[1]')], 'patient-all')
+        bundle.add_payloads([('prefecture-metrics.json', '[1]')], 'prefecture-metrics')
+        bundle.upload(bucket)
+
+        bundle = _bundle()
+        bundle.add_payloads([('prefecture-metrics.json', '[2]')], 'prefecture-metrics')
+        bundle.upload(bucket)
+        self.assertEqual(_bundle().read_pack(bucket), {
+            'patient-all.json': b'[1]',
+            'prefecture-metrics.json': b'[2]',
+        })
+
+    def test_incomplete_pack_is_not_uploaded(self):
+        bucket = FakeBucket()
+        bundle = _bundle()
+        bundle.add_payloads([('prefecture-metrics.json', '[1]')], 'prefecture-metrics')
+
+        self.assertIsNone(bundle.upload(bucket))
+        self.assertEqual(bucket.store, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
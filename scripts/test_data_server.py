@@ -0,0 +1,44 @@
+import json
+import unittest
+
+import data_server
+import datasets
+
+
+class FrameDataset(datasets.Dataset):
+    NAME = 'frame'
+
+    def __init__(self, rows, fail=False):
+        super().__init__('frame-source', self.NAME, cache_stages=False, memory_budget=0, languages=('vi', 'ja', 'en'))
+        self.rows = rows
+        self.fail = fail
+
+    def _fetch_source(self):
+        return b''
+
+    def _create_dataframe(self):
+        if self.fail:
+            raise ValueError('Source unavailable')
+        return datasets.pd.DataFrame({'value': list(range(self.rows))})
+
+
+class DataStoreTest(unittest.TestCase):
+    def test_failed_reload_keeps_every_language(self):
+        factory = [FrameDataset(2)]
+        store = data_server.DataStore(lambda: factory)
+        store.load()
+        previous = dict(store.artifacts)
+        self.assertEqual(sorted(previous), ['frame.en.json', 'frame.ja.json', 'frame.json'])
+
+        factory = [FrameDataset(3, fail=True)]
+        store.load()
+        self.assertEqual(store.artifacts, previous)
+        self.assertIn(FrameDataset.NAME, store.indexes)
+
+        factory = [FrameDataset(3)]
+        store.load()
+        self.assertEqual(len(json.loads(store.artifact('frame.en.json').body)), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import datasets
+
+
+class DriftingCsvDataset(datasets.CsvDataset):
+    """Columns whose types differ between chunks of the parse."""
+    NAME = 'drifting-csv'
+
+    COL_NUMBER = 'number'
+    COL_NOTE = 'note'
+    COL_CODE = 'code'
+
+    def _localize(self):
+        # More than 127 categories in the later chunks widens the indices of
+        # the dictionary from int8 to int16
+        self._encode(self.COL_CODE, {}, {'c0': {datasets.LANGUAGE_JA: 'コード0'}})
+        return self.dataframe
+
+
+class DriftingJsonDataset(datasets.JsonDataset):
+    """Records missing a key in the first chunks."""
+    NAME = 'drifting-json'
+    RECORD_PATH = 'data[]'
+
+
+def _write(directory, name, text):
+    path = os.path.join(directory, name)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return path
+
+
+class SpilledQueryTest(unittest.TestCase):
+    CHUNK_ROWS = 50
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        patcher = mock.patch.object(datasets, 'SPILL_DIR', os.path.join(self.directory, 'spill'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _query(self, cls, path, spill):
+        dataset = cls(path, cls.NAME, cache_stages=False, memory_budget=0, languages=('vi', 'ja'))
+        dataset.check_schema = lambda: None
+        if spill:
+            dataset._query_all_spilled(self.CHUNK_ROWS)
+        else:
+            dataset.query_all()
+        return dataset
+
+    def assert_same_output(self, cls, path):
+        whole = self._query(cls, path, spill=False)
+        spilled = self._query(cls, path, spill=True)
+
+        self.assertTrue(spilled.spilled)
+        self.assertEqual(list(spilled.dataframe.columns), list(whole.dataframe.columns))
+        self.assertEqual(list(spilled.dataframe.index), list(whole.dataframe.index))
+        self.assertEqual(spilled.serialize(), whole.serialize())
+        return whole, spilled
+
+    def test_csv_chunks_with_drifting_types(self):
+        lines = ['number,note,code']
+        for i in range(200):
+            number = '' if i == 120 else str(i)  # int64 chunks, then a float64 one
+            note = f'note {i}' if i >= 150 else ''  # all-null chunks, then strings
+            lines.append(f'{number},{note},c{i}')
+        path = _write(self.directory, 'drifting.csv', '\n'.join(lines) + '\n')
+
+        whole, spilled = self.assert_same_output(DriftingCsvDataset, path)
+        self.assertEqual(spilled.dataframe[DriftingCsvDataset.COL_NUMBER].dtype, whole.dataframe['number'].dtype)
+        self.assertEqual(spilled.dataframe[DriftingCsvDataset.COL_CODE].dtype.name, 'category')
+
+    @unittest.skipIf(datasets.ijson is None, 'ijson is not installed')
+    def test_json_chunks_missing_a_key(self):
+        records = [{'id': i, 'name': f'name {i}'} for i in range(120)]
+        records += [{'id': i, 'name': f'name {i}', 'extra': i / 2} for i in range(120, 200)]
+        path = _write(self.directory, 'drifting.json', json.dumps({'data': records}))
+
+        self.assert_same_output(DriftingJsonDataset, path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import datasets
+import pipeline
+
+
+class FakeBlob(object):
+    def __init__(self, store, name, failing=()):
+        self.store = store
+        self.name = name
+        self.failing = failing
+
+    def exists(self):
+        return self.name in self.store
+
+    def upload_from_string(self, data, content_type=None):
+        if self.name in self.failing:
+            raise ConnectionError(f'Failed to upload {self.name}')
+        self.store[self.name] = data
+
+    def download_as_string(self):
+        data = self.store[self.name]
+        return data.encode() if isinstance(data, str) else data
+
+
+class FakeBucket(object):
+    def __init__(self, failing=()):
+        self.store = {}
+        self.failing = failing
+
+    def blob(self, name):
+        return FakeBlob(self.store, name, self.failing)
+
+
+class CountingCsvDataset(datasets.CsvDataset):
+    NAME = 'counting-csv'
+    SCHEMA = {'columns': ['a', 'b']}
+
+    def __init__(self, url, **kwargs):
+        super().__init__(url, self.NAME, cache_stages=False, memory_budget=0, **kwargs)
+        self.fetches = 0
+
+    def _fetch_source(self):
+        self.fetches += 1
+        return super()._fetch_source()
+
+
+class DerivedDataset(datasets.Dataset):
+    """Row count of another dataset, from a source of its own that never changes."""
+    NAME = 'derived'
+
+    def __init__(self, base, **kwargs):
+        super().__init__('derived-source', self.NAME, cache_stages=False, memory_budget=0, **kwargs)
+        self.base = base
+        self.dependencies = [base]
+        base.retain()
+
+    def _fetch_source(self):
+        return b'unchanged'
+
+    def _create_dataframe(self):
+        return datasets.pd.DataFrame({'rows': [len(self.base.query_all())]})
+
+
+def _kill_before_close(journal):
+    # The journal of a killed run is never closed
+    journal.close = lambda failed=(): None
+    return journal
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        patcher = mock.patch.object(datasets, 'CACHE_DIR', self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_incompatible_source_is_not_downloaded(self):
+        dataset = CountingCsvDataset(self._write('source.csv', 'a,c\n1,2\n'))
+        bucket = FakeBucket()
+        runner = pipeline.Pipeline(bucket)
+        runner.run([dataset])
+
+        self.assertIsInstance(runner.errors[dataset.name], datasets.SchemaError)
+        self.assertEqual(dataset.fetches, 0)
+        self.assertEqual(bucket.store, {})
+
+    def _datasets(self, path):
+        base = CountingCsvDataset(path)
+        return [base, DerivedDataset(base)]
+
+    def _run(self, datasets_, journal=None):
+        bucket = FakeBucket()
+        runner = pipeline.Pipeline(bucket, journal=journal or pipeline.RunJournal())
+        runner.run(datasets_)
+        self.assertEqual(runner.errors, {})
+        return bucket
+
+    def test_resume_skips_unchanged_datasets(self):
+        path = self._write('source.csv', 'a,b\n1,2\n')
+        self._run(self._datasets(path), _kill_before_close(pipeline.RunJournal()))
+
+        bucket = self._run(self._datasets(path))
+        self.assertEqual(bucket.store, {})
+
+    def test_resume_reruns_datasets_derived_from_a_changed_source(self):
+        path = self._write('source.csv', 'a,b\n1,2\n')
+        self._run(self._datasets(path), _kill_before_close(pipeline.RunJournal()))
+
+        self._write('source.csv', 'a,b\n1,2\n3,4\n')
+        bucket = self._run(self._datasets(path))
+        self.assertEqual(sorted(bucket.store), ['counting-csv.json', 'derived.json'])
+        self.assertEqual(json.loads(bucket.store['derived.json']), [{'rows': 2}])
+
+    def test_failed_upload_resumes_from_the_spooled_payloads(self):
+        path = self._write('source.csv', 'a,b\n1,2\n')
+        journal = pipeline.RunJournal()
+        runner = pipeline.Pipeline(FakeBucket(failing={'derived.json'}), journal=journal)
+        runner.run(self._datasets(path))
+        self.assertEqual(list(runner.errors), ['derived'])
+        self.assertEqual(list(journal.entries), ['derived'])
+
+        datasets_ = self._datasets(path)
+        with mock.patch.object(datasets_[1], 'serialize', side_effect=AssertionError('serialized again')):
+            bucket = self._run(datasets_)
+        # Only the failed dataset resumes, the others run from scratch
+        self.assertEqual(sorted(bucket.store), ['counting-csv.json', 'derived.json'])
+        self.assertEqual(json.loads(bucket.store['derived.json']), [{'rows': 1}])
+        with open(journal.path) as f:
+            self.assertEqual(json.load(f)['complete'], True)
+
+
+if __name__ == '__main__':
+    unittest.main()
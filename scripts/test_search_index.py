@@ -0,0 +1,77 @@
+import json
+import random
+import tempfile
+import unittest
+
+import search_index
+
+
+class FakeBlob(object):
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def upload_from_string(self, data, content_type=None):
+        self.store[self.name] = data
+
+
+class FakeBucket(object):
+    def __init__(self):
+        self.store = {}
+
+    def blob(self, name):
+        return FakeBlob(self.store, name)
+
+
+KANA = [chr(code) for code in range(0x30a2, 0x30f3)]
+
+
+def _documents(count, seed=0):
+    rng = random.Random(seed)
+    return [
+        (f'clinic-{i}', [f'{rng.randrange(10 ** 7):07d}', ''.join(rng.choice(KANA) for _ in range(6)) + 'クリニック'])
+        for i in range(count)
+    ]
+
+
+class SearchIndexTest(unittest.TestCase):
+    MAX_BYTES = 16 * 1024
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.index = search_index.SearchIndex('clinic', cache_dir=directory.name)
+        self.documents = _documents(3000)
+        self.index.update('tokyo', 'digest', lambda: self.documents)
+
+    def _lookup(self, shards, shard_count, split_grams, gram):
+        if gram in split_grams:
+            return [doc_id for key in split_grams[gram] for doc_id in shards[key][gram]]
+        return shards.get(search_index.shard_key(gram, shard_count), {}).get(gram, [])
+
+    def test_shards_are_capped(self):
+        shards, shard_count, split_grams = self.index.shards(self.MAX_BYTES)
+        sizes = [len(json.dumps(shard, sort_keys=True).encode()) for shard in shards.values()]
+        self.assertLessEqual(max(sizes), self.MAX_BYTES)
+        # In the name of every clinic
+        self.assertIn('クリ', split_grams)
+
+    def test_every_posting_is_found_in_its_shard(self):
+        shards, shard_count, split_grams = self.index.shards(self.MAX_BYTES)
+        for gram, doc_ids in self.index.postings['tokyo'].items():
+            self.assertEqual(self._lookup(shards, shard_count, split_grams, gram), doc_ids)
+
+    def test_uploaded_index_describes_the_shards(self):
+        bucket = FakeBucket()
+        self.index.upload_to_storage(bucket)
+        index = json.loads(bucket.store['clinic-search/index.json'])
+        gram = search_index.ngrams('クリニック').pop()
+        shard = json.loads(bucket.store[
+            f'clinic-search/{search_index.shard_key(gram, index["shard_count"])}.json'
+        ])
+        self.assertEqual(len(shard[gram]), len(self.documents))
+        self.assertEqual(search_index.gram_hash('a'), 0xe40c292c)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import datasets
+import localization
+import update_data
+
+
+def strict_loads(data_str):
+    """json.loads rejecting the NaN/Infinity tokens that browsers cannot parse."""
+    def reject(token):
+        raise ValueError(f'Invalid JSON token {token}')
+    return json.loads(data_str, parse_constant=reject)
+
+
+def _write_prefecture_by_date(directory, days=21):
+    data47 = []
+    for i, name in enumerate(localization.PREFECTURES):
+        # No case at all in half of the prefectures, so most metrics are undefined
+        data = [0] * days if i % 2 else [(day * i) % 7 for day in range(days)]
+        data47.append({'name': name, 'data': data})
+    path = os.path.join(directory, 'prefecture-by-date.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'category': [f'4/{day + 1}' for day in range(days)], 'data47': data47}, f, ensure_ascii=False)
+    return path
+
+
+class UpdateDataTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        patcher = mock.patch.object(datasets, 'CACHE_DIR', self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.prefecture_by_date = update_data.PrefectureByDateDataset(
+            cache_stages=False, languages=('vi', 'ja', 'en'))
+        self.prefecture_by_date.url = _write_prefecture_by_date(self.directory)
+
+    def test_prefecture_metrics_serialize_to_strict_json(self):
+        dataset = update_data.PrefectureMetricsDataset(self.prefecture_by_date, languages=('vi', 'ja', 'en'))
+        dataset.query_all()
+        self.assertTrue(dataset.dataframe[update_data.PrefectureMetricsDataset.COL_WEEK_OVER_WEEK].isna().any())
+
+        for storage_ref, data_str in dataset.serialize():
+            records = strict_loads(data_str)
+            self.assertEqual(len(records), len(localization.PREFECTURES), storage_ref)
+        self.assertIsNone(records[1][update_data.PrefectureMetricsDataset.COL_WEEK_OVER_WEEK])
+
+    def test_prefecture_map_serializes_to_strict_json(self):
+        metrics = update_data.PrefectureMetricsDataset(self.prefecture_by_date, languages=('vi', 'ja', 'en'))
+        dataset = update_data.PrefectureMapDataset(self.prefecture_by_date, metrics, languages=('vi', 'ja', 'en'))
+        dataset.query_all()
+
+        payloads = dataset.serialize()
+        self.assertEqual([storage_ref for storage_ref, _ in payloads], [
+            'prefecture-map.json', 'prefecture-map.ja.json', 'prefecture-map.en.json'])
+        for storage_ref, data_str in payloads:
+            geojson = strict_loads(data_str)
+            properties = [
+                feature['properties'] for feature in geojson['features']
+                if update_data.PrefectureMapDataset.COL_TOTAL in feature['properties']
+            ]
+            self.assertEqual(len(properties), len(localization.PREFECTURES), storage_ref)
+        self.assertIn(None, [
+            feature[update_data.PrefectureMetricsDataset.COL_WEEK_OVER_WEEK] for feature in properties])
+
+    def test_saitama_pdf_url_is_resolved_on_fetch(self):
+        page = '<a href="a0701/covid19/list.pdf">陽性確認者一覧（4月1日）</a>'.encode()
+        with mock.patch.object(datasets.SCHEDULER, 'fetch', side_effect=[page, b'%PDF']) as fetch:
+            dataset = update_data.PatientByCitySaitamaDataset(cache_stages=False)
+            fetch.assert_not_called()
+
+            self.assertEqual(dataset.get_source(), b'%PDF')
+        self.assertEqual(fetch.call_args_list[1][0][0], 'https://www.pref.saitama.lg.jp/a0701/covid19/list.pdf')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,27 +1,58 @@
+import argparse
+import concurrent.futures
+import datetime
+import io
 import json
 import locale
+import os
 import re
-import urllib.request
 import sys
 import traceback
+import urllib.parse
 
 import firebase_admin
 from firebase_admin import credentials, firestore, storage
+import numpy as np
 import pandas as pd
 import tabula
 
+import bundles
 import datasets
 import localization
+import mapdata
+import memory
+import metrics
+import pipeline
+import profiler
+import registry
+import search_index
 
 
 FIREBASE_APP_NAME = 'thongtincovid19-4dd12'
 FIREBASE_PRIVATE_KEY = './thongtincovid19_serviceaccount_privatekey.json'
 FIREBASE_STORAGE_BUCKET = 'gs://thongtincovid19-4dd12.appspot.com'
 
+POSTAL_CODE_SHARD_LENGTH = 3
+# Bundles packing the artifacts fetched together by the data page:
+# {bundle name: dataset name patterns}
+DETAILED_BUNDLES = {
+    'data': ['prefecture-by-date', 'prefecture-metrics', 'patient-by-city-*'],
+}
+# Jekyll data directory, rendered into the static pages at build time
+SITE_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, '_data')
 
+
+@registry.register(shard_by=datasets.SHARD_BY_MONTH)
 class TokyoPatientsDataset(datasets.CsvDataset):
     URL = 'https://stopcovid19.metro.tokyo.lg.jp/data/130001_tokyo_covid19_patients.csv'
     NAME = 'patient-tokyo'
+    SCHEMA = {
+        'columns': [
+            'No', '全国地方公共団体コード', '都道府県名', '市区町村名', '公表_年月日', '曜日', '発症_年月日',
+            '患者_居住地', '患者_年代', '患者_性別', '患者_属性', '患者_状態', '患者_症状',
+            '患者_渡航歴の有無フラグ', '備考', '退院済フラグ',
+        ],
+    }
 
     COL_NO = 'STT'
     COL_AREA_CODE = 'Mã vùng'
@@ -40,6 +71,14 @@ class TokyoPatientsDataset(datasets.CsvDataset):
     COL_REF = 'Tham khảo'
     COL_DISCHARGED = 'Đã ra viện hay chưa'
 
+    SHARD_DATE_COLUMN = COL_PUBLISHED_DATE
+    SHARD_PREFECTURE_COLUMN = COL_PREFECTURE
+    PARTITIONABLE = True
+    DATE_OUTPUT_FORMATS = {
+        COL_PUBLISHED_DATE: ('%Y-%m-%d', None),
+        COL_SYMPTOM_DATE: ('%Y-%m-%d', None),
+    }
+
     def __init__(self, **kwargs):
         super().__init__(self.URL, self.NAME, **kwargs)
 
@@ -47,36 +86,24 @@ class TokyoPatientsDataset(datasets.CsvDataset):
         self._localize_column_names()
 
         # Localize data
-        self.dataframe[self.COL_PREFECTURE].replace({
-            '東京都': 'Tokyo'
-        }, inplace=True)
-        self.dataframe[self.COL_DOW].replace({
-            '日': 'CN',
-            '月': '2',
-            '火': '3',
-            '水': '4',
-            '木': '5',
-            '金': '6',
-            '土': '7',
-        }, inplace=True)
-        self.dataframe[self.COL_PATIENT_ADDRESS].replace({
-            **localization.PREFECTURES,
-            '湖北省武漢市': 'Vũ Hán, Hồ Bắc',
-            '湖南省長沙市': 'Trường Sa, Hồ Nam',
-            '都内': 'Nội đô Tokyo',
-            '都外': 'Ngoài Tokyo',
-            '調査中': 'Đang điều tra',
-        }, inplace=True)
-
-        self._localize_age(self.COL_PATIENT_SEX)
+        self._localize_prefecture(self.COL_PREFECTURE)
+        self._localize_day_of_week(self.COL_DOW)
+        self._localize_prefecture(self.COL_PATIENT_ADDRESS, others={
+            '湖北省武漢市': {'vi': 'Vũ Hán, Hồ Bắc', 'en': 'Wuhan, Hubei'},
+            '湖南省長沙市': {'vi': 'Trường Sa, Hồ Nam', 'en': 'Changsha, Hunan'},
+            '都内': {'vi': 'Nội đô Tokyo', 'en': 'Within Tokyo'},
+            '都外': {'vi': 'Ngoài Tokyo', 'en': 'Outside Tokyo'},
+            '調査中': {'vi': 'Đang điều tra', 'en': 'Under investigation'},
+        }, na_code='―')
+
+        self._localize_sex(self.COL_PATIENT_SEX)
         self._localize_age(self.COL_PATIENT_AGE)
+        self._localize_date(self.COL_PUBLISHED_DATE, datasets.DATE_ISO)
+        self._localize_date(self.COL_SYMPTOM_DATE, datasets.DATE_ISO)
 
         return self.dataframe
 
     def _cleanse(self, auto_drop=False):
-        # Fill missing data
-        self.dataframe[self.COL_PATIENT_ADDRESS].fillna('―', inplace=True)
-
         if auto_drop:
             # Drop meaningless columns (less than 1 unique value)
             self.dataframe.drop(columns=[
@@ -95,83 +122,302 @@ class TokyoPatientsDataset(datasets.CsvDataset):
         return self.dataframe
 
 
+@registry.register()
 class PrefectureByDateDataset(datasets.JsonDataset):
     URL = 'https://www3.nhk.or.jp/news/special/coronavirus/data/47newpatients-data.json'
     NAME = 'prefecture-by-date'
+    SCHEMA = {'keys': ['category', 'data47']}
 
     COL_PREFECTURE = 'Tỉnh/Thành phố'
     COL_TOTAL = 'Tổng'
 
+    SHARD_PREFECTURE_COLUMN = COL_PREFECTURE
+
     def __init__(self, **kwargs):
         super().__init__(self.URL, self.NAME, **kwargs)
 
     def _create_dataframe_from_json(self):
-        formatted_list = []
-        for pref in self.json['data47']:
-            formatted_list.append([pref['name']] + pref['data'] + [sum(pref['data'])])
         dates = self.json['category']
         self.dataframe = pd.DataFrame(
-            formatted_list,
-            columns=[self.COL_PREFECTURE] + dates + [self.COL_TOTAL]
+            [pref['data'] for pref in self.json['data47']],
+            columns=dates,
         )
+        self.dataframe[self.COL_TOTAL] = self.dataframe.to_numpy().sum(axis=1)
+        self.dataframe.insert(0, self.COL_PREFECTURE, [pref['name'] for pref in self.json['data47']])
+
+        return self.dataframe
+
+    def _localize(self):
+        self._localize_prefecture(self.COL_PREFECTURE)
+        return self.dataframe
+
+
+@registry.register(PrefectureByDateDataset.NAME)
+class PrefectureMetricsDataset(datasets.Dataset):
+    """Latest epidemiological metrics of each prefecture, for the map."""
+    NAME = 'prefecture-metrics'
+
+    COL_PREFECTURE = 'Tỉnh/Thành phố'
+    COL_DATE = 'date'
+    COL_NEW_CASES = 'new_cases'
+    COL_CUMULATIVE = metrics.CUMULATIVE
+    COL_AVERAGE = metrics.AVERAGE
+    COL_WEEK_OVER_WEEK = metrics.WEEK_OVER_WEEK
+    COL_DOUBLING_DAYS = metrics.DOUBLING_DAYS
+    COL_CUMULATIVE_RATE = metrics.CUMULATIVE_RATE
+    COL_AVERAGE_RATE = metrics.AVERAGE_RATE
+
+    def __init__(self, prefecture_by_date=None, **kwargs):
+        if prefecture_by_date is None:
+            prefecture_by_date = PrefectureByDateDataset()
+        super().__init__(prefecture_by_date.url, self.NAME, cache_stages=False, **kwargs)
+        self.prefecture_by_date = prefecture_by_date
+        self.metrics = None
+
+    def free(self):
+        super().free()
+        self.metrics = None
+
+    def _fetch_source(self):
+        return self.prefecture_by_date.get_source()
+
+    def _create_dataframe(self):
+        source = self.prefecture_by_date.query_all()
+        dates = [
+            column for column in source.columns
+            if column not in (PrefectureByDateDataset.COL_PREFECTURE, PrefectureByDateDataset.COL_TOTAL)
+        ]
+        prefectures = source[PrefectureByDateDataset.COL_PREFECTURE].astype(str).tolist()
+        population = np.array([localization.PREFECTURE_POPULATION.get(p, np.nan) for p in prefectures])
+        daily = source[dates].to_numpy(dtype=float)
+
+        engine = metrics.MetricsEngine(self.NAME)
+        self.metrics = engine.update(prefectures, dates, daily, population)
+        print(f'Computed metrics for {engine.recomputed_columns}/{len(dates)} dates')
+
+        dataframe = pd.DataFrame({
+            self.COL_PREFECTURE: prefectures,
+            self.COL_DATE: dates[-1],
+            self.COL_NEW_CASES: daily[:, -1],
+            **{metric: values[:, -1] for metric, values in self.metrics.items()},
+        })
+        return dataframe.round(2).replace([np.inf, -np.inf], np.nan)
 
+    def _localize(self):
+        self._localize_prefecture(self.COL_PREFECTURE)
         return self.dataframe
 
+
+@registry.register(PrefectureByDateDataset.NAME, PrefectureMetricsDataset.NAME)
+class PrefectureMapDataset(datasets.Dataset):
+    """Prefecture geometry joined with the totals and metrics, for the choropleth.
+
+    Published as a single GeoJSON per language whose features carry the
+    values, so the page loads neither js/mapdata/jp-all.js nor
+    prefecture-by-date.json.
+    """
+    NAME = 'prefecture-map'
+
+    COL_PREFECTURE = 'Tỉnh/Thành phố'
+    COL_DATE = PrefectureMetricsDataset.COL_DATE
+    COL_TOTAL = 'value'
+    # Metrics shown in the tooltip, see initMaps() in js/main.js
+    METRIC_COLUMNS = [
+        PrefectureMetricsDataset.COL_NEW_CASES,
+        PrefectureMetricsDataset.COL_AVERAGE,
+        PrefectureMetricsDataset.COL_WEEK_OVER_WEEK,
+        PrefectureMetricsDataset.COL_AVERAGE_RATE,
+    ]
+
+    def __init__(
+        self,
+        prefecture_by_date=None,
+        prefecture_metrics=None,
+        tolerance=mapdata.SIMPLIFY_TOLERANCE,
+        quantum=mapdata.QUANTUM,
+        **kwargs
+    ):
+        if prefecture_by_date is None:
+            prefecture_by_date = PrefectureByDateDataset()
+        if prefecture_metrics is None:
+            prefecture_metrics = PrefectureMetricsDataset(prefecture_by_date)
+        super().__init__(mapdata.MAP_DATA_PATH, self.NAME, cache_stages=False, **kwargs)
+        self.prefecture_by_date = prefecture_by_date
+        self.prefecture_metrics = prefecture_metrics
+        self.tolerance = tolerance
+        self.quantum = quantum
+        self.geometry = None
+
+    def free(self):
+        super().free()
+        self.geometry = None
+
+    def _create_dataframe(self):
+        self.geometry = mapdata.simplify_map(
+            mapdata.parse_highcharts_map(self.get_source().decode('utf-8')), self.tolerance, self.quantum)
+
+        totals = self.prefecture_by_date.query_all()
+        metrics_frame = self.prefecture_metrics.query_all()
+        # Both are coded by the Japanese names of localization.PREFECTURES
+        dataframe = pd.DataFrame({
+            self.COL_PREFECTURE: totals[PrefectureByDateDataset.COL_PREFECTURE].astype(str).to_numpy(),
+            self.COL_TOTAL: totals[PrefectureByDateDataset.COL_TOTAL].to_numpy(),
+        })
+        return dataframe.merge(
+            pd.DataFrame({
+                self.COL_PREFECTURE: metrics_frame[PrefectureMetricsDataset.COL_PREFECTURE].astype(str).to_numpy(),
+                self.COL_DATE: metrics_frame[PrefectureMetricsDataset.COL_DATE].to_numpy(),
+                **{column: metrics_frame[column].to_numpy() for column in self.METRIC_COLUMNS},
+            }),
+            on=self.COL_PREFECTURE,
+            how='left',
+        )
+
     def _localize(self):
-        self.dataframe[self.COL_PREFECTURE].replace(localization.PREFECTURES, inplace=True)
+        self._localize_prefecture(self.COL_PREFECTURE)
         return self.dataframe
 
+    def to_geojson(self, language=datasets.DEFAULT_LANGUAGE):
+        """
+        returns
+            the simplified geometry with the values of each prefecture in its feature properties
+        """
+        codes = {romaji: name for name, romaji in localization.PREFECTURES.items()}
+        rows = dict(zip(
+            self.dataframe[self.COL_PREFECTURE].astype(str),
+            self.to_dict(replace_nan=True, dataframe=self.dataframe.drop(columns=[self.COL_PREFECTURE, self.COL_DATE])),
+        ))
+        date = self.dataframe[self.COL_DATE].dropna()
+
+        features = []
+        for feature in self.geometry['features']:
+            properties = feature['properties']
+            code = codes.get(properties.get('name'))
+            if code is not None:
+                properties = {**properties, **rows.get(code, {}), 'name': self.label(self.COL_PREFECTURE, code, language)}
+            features.append({**feature, 'properties': properties})
+
+        return {
+            **self.geometry,
+            'features': features,
+            'date': str(date.iloc[0]) if len(date) else None,
+        }
+
+    def serialize(self, extension='json'):
+        if extension != 'json':
+            raise NotImplementedError(f'Unsupported file type "{extension}"')
+
+        return [
+            (
+                f'{self.name}{self._language_suffix(language)}.{extension}',
+                json.dumps(self.to_geojson(language), ensure_ascii=False, separators=(',', ':'), allow_nan=False),
+            )
+            for language in self.languages
+        ]
 
+
+@registry.register()
 class PatientDetailsDataset(datasets.JsonDataset):
-    URL = (
-        'https://services8.arcgis.com/JdxivnCyd1rvJTrY/ArcGIS/rest/services/v2_covid19_list_csv/FeatureServer/0/'
-        'query?where=1=1'
-        '&geometryType=esriGeometryEnvelope'
-        '&spatialRel=esriSpatialRelIntersects'
-        '&resultType=none'
-        '&distance=0.0'
-        '&units=esriSRUnit_Meter'
-        '&returnGeodetic=false'
-        '&outFields=*'
-        '&returnGeometry=false'
-        '&featureEncoding=esriDefault'
-        '&multipatchOption=xyFootprint&'
-        '&applyVCSProjection=false'
-        '&returnIdsOnly=false'
-        '&returnUniqueIdsOnly=false'
-        '&returnCountOnly=false'
-        '&returnExtentOnly=false'
-        '&returnQueryGeometry=false'
-        '&returnDistinctValues=false'
-        '&cacheHint=false'
-        '&resultRecordCount=0'
-        '&returnZ=false'
-        '&returnM=false'
-        '&returnExceededLimitFeatures=true'
-        '&sqlFormat=none'
-        '&f=pjson'
-    )
+    URL = 'https://services8.arcgis.com/JdxivnCyd1rvJTrY/ArcGIS/rest/services/v2_covid19_list_csv/FeatureServer/0/query'
     NAME = 'patient-all'
+    SCHEMA = {'keys': ['features']}
+    RECORD_PATH = 'features[].attributes'
+    # Checked against the fields of the layer before querying
+    OUT_FIELDS = (
+        'ObjectId', 'Date', '年代', '性別', '確定日', '発症日', '受診都道府県', '居住都道府県', '居住市区町村', 'ステータス',
+    )
+    # Only used when the layer does not report its maxRecordCount
+    DEFAULT_PAGE_SIZE = 1000
+    PAGE_WORKERS = 4
 
+    COL_OBJECT_ID = 'ObjectId'
     COL_DATE = 'Date'
 
-    def __init__(self, **kwargs):
-        super().__init__(self.URL, self.NAME, **kwargs)
+    PARTITIONABLE = True
+    DATE_OUTPUT_FORMATS = {COL_DATE: ('%Y%m%d %H:%M', None)}
 
-    def _create_dataframe_from_json(self):
-        self.dataframe = pd.DataFrame([entry['attributes'] for entry in self.json['features']])
-        return self.dataframe
+    def __init__(self, full_sync=False, **kwargs):
+        """
+        full_sync
+            Ignore the locally synced features and download all of them again.
+        """
+        super().__init__(self.URL, self.NAME, **kwargs)
+        self.full_sync = full_sync
+        self.sync_path = os.path.join(datasets.CACHE_DIR, 'arcgis', f'{self.NAME}.json')
+
+    def _request(self, url, **params):
+        # A stale cached answer of a count or page query would silently
+        # skip features, so failures are raised instead
+        data = json.loads(datasets.SCHEDULER.fetch(
+            f'{url}?{urllib.parse.urlencode({"f": "json", **params})}',
+            headers=datasets.QUERY_HEADERS,
+            allow_stale=False,
+        ))
+        if 'error' in data:
+            raise RuntimeError(f'ArcGIS request failed: {data["error"]}')
+        return data
+
+    def _query(self, **params):
+        return self._request(self.url, outFields=','.join(self.OUT_FIELDS), returnGeometry='false', **params)
+
+    def _page_size(self):
+        """Check OUT_FIELDS against the layer metadata.
+
+        returns
+            maxRecordCount of the layer
+        """
+        layer = self._request(self.url[:-len('/query')])
+        fields = [field['name'] for field in layer.get('fields', [])]
+        missing = [field for field in self.OUT_FIELDS if field not in fields]
+        if missing:
+            raise datasets.SchemaError(
+                f'Fields {missing} of {self.name} are not in the layer, available fields: {fields}'
+            )
+        return layer.get('maxRecordCount') or self.DEFAULT_PAGE_SIZE
+
+    def _fetch_source(self):
+        """Download features newer than the last synced ObjectId, page by page in parallel."""
+        features = []
+        if not self.full_sync and os.path.exists(self.sync_path):
+            with open(self.sync_path) as f:
+                features = json.load(f)['features']
+        last_id = max((feature['attributes'][self.COL_OBJECT_ID] for feature in features), default=0)
+
+        page_size = self._page_size()
+        where = f'{self.COL_OBJECT_ID}>{last_id}'
+        count = self._query(where=where, returnCountOnly='true')['count']
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.PAGE_WORKERS) as executor:
+            pages = executor.map(lambda offset: self._query(
+                where=where,
+                orderByFields=self.COL_OBJECT_ID,
+                resultOffset=offset,
+                resultRecordCount=page_size,
+            )['features'], range(0, count, page_size))
+            for page in pages:
+                features.extend(page)
+        print(f'Synced {count} new features of {self.name}, {len(features)} in total')
+
+        source = json.dumps({'features': features}, separators=(',', ':')).encode()
+        os.makedirs(os.path.dirname(self.sync_path), exist_ok=True)
+        with open(self.sync_path, 'wb') as f:
+            f.write(source)
+        return source
 
     def _cleanse(self):
-        self.dataframe[self.COL_DATE].fillna(0, inplace=True)
-        self.dataframe[self.COL_DATE] = pd.to_datetime(self.dataframe[self.COL_DATE], unit='ms')
-        self.dataframe[self.COL_DATE] = self.dataframe[self.COL_DATE].dt.strftime('%Y%m%d %H:%M')
-        return self.dataframe[self.COL_DATE]
+        return self._localize_date(self.COL_DATE, datasets.DATE_EPOCH_MS)
 
 
+@registry.register()
 class PatientByCityTokyoDataset(datasets.JsonDataset):
     URL = 'https://raw.githubusercontent.com/tokyo-metropolitan-gov/covid19/development/data/patient.json'
     NAME = 'patient-by-city-tokyo'
+    RECORD_PATH = 'datasets.data[]'
+    SCHEMA = {
+        'keys': ['datasets.data'],
+        'records': 'datasets.data',
+        'columns': ['code', 'area', 'label', 'ruby', 'count'],
+        'ordered': False,
+    }
 
     COL_CODE = 'code'
     COL_AREA = 'area'
@@ -184,9 +430,6 @@ class PatientByCityTokyoDataset(datasets.JsonDataset):
     def __init__(self, **kwargs):
         super().__init__(self.URL, self.NAME, **kwargs)
 
-    def _create_dataframe_from_json(self):
-        return pd.DataFrame(self.json['datasets']['data'])
-
     def _cleanse(self):
         self.dataframe[self.COL_CODE].fillna(0, inplace=True)
         self.dataframe[self.COL_CODE] = self.dataframe[self.COL_CODE].astype(int)
@@ -214,11 +457,13 @@ class PatientByCityTokyoDataset(datasets.JsonDataset):
         return self.dataframe
 
 
+@registry.register()
 class PatientByCityOsakaDataset(datasets.ExcelDataset):
     URL = 'https://github.com/codeforosaka/covid19/blob/development/data/patients_and_inspections.xlsx?raw=true'
     NAME = 'patient-by-city-osaka'
     SHEET = 1
     HEADER = 1
+    SCHEMA = {'columns': 8}
 
     COL_ID = 'Id'
     COL_PUBLISHED_DATE = 'Published date'
@@ -229,13 +474,21 @@ class PatientByCityOsakaDataset(datasets.ExcelDataset):
     COL_STATUS = 'Status'
     COL_DISCHARGED = 'Discharged'
 
-    def __init__(self, **kwargs):
-        super().__init__(self.URL, self.NAME, self.SHEET, self.HEADER, **kwargs)
+    DATE_OUTPUT_FORMATS = {
+        COL_PUBLISHED_DATE: ('%Y-%m-%d %H:%M:%S', None),
+        COL_SYMPTOM_DATE: ('%Y-%m-%d %H:%M:%S', None),
+    }
 
-    def _cleanse(self):
-        self.dataframe[self.COL_PUBLISHED_DATE] = self.dataframe[self.COL_PUBLISHED_DATE].astype(str)
-        self.dataframe[self.COL_SYMPTOM_DATE] = self.dataframe[self.COL_SYMPTOM_DATE].astype(str)
-        return self.dataframe
+    def __init__(self, **kwargs):
+        super().__init__(
+            self.URL,
+            self.NAME,
+            self.SHEET,
+            self.HEADER,
+            usecols=range(8),
+            date_columns=[1, 5],
+            **kwargs
+        )
 
     def _localize(self):
         self._localize_column_names()
@@ -249,17 +502,12 @@ class PatientByCityOsakaDataset(datasets.ExcelDataset):
             outsider_value='Ngoài phủ',
         )
 
-        self.dataframe[self.COL_DISCHARGED].replace({
-            '退院': 'Ra viện',
-            '死亡退院': 'Tử vong',
-            '入院中': 'Đang nằm viện',
-            '入院調整中': 'Chuẩn bị nhập viện',
-            '管外': 'Không quản lý',
-        }, inplace=True)
+        self._localize_status(self.COL_DISCHARGED)
 
         return self.dataframe
 
 
+@registry.register()
 class PatientByCitySaitamaDataset(datasets.PdfDataset):
     BASE_URL = 'https://www.pref.saitama.lg.jp/'
     URL = 'https://www.pref.saitama.lg.jp/a0701/covid19/jokyo.html'
@@ -272,18 +520,23 @@ class PatientByCitySaitamaDataset(datasets.PdfDataset):
     COL_SEX = 'Sex'
     COL_LOCATION = 'Location'
 
+    DATE_OUTPUT_FORMATS = {COL_DATE: (datasets.OUTPUT_MONTH_DAY, localization.LOCATION_LABELS['unknown'])}
+
     def __init__(self, **kwargs):
-        super().__init__(self._find_url(), self.NAME, include_header=False, **kwargs)
+        # The PDF link is found on the status page when the source is fetched,
+        # so that building the registry does not hit the network
+        super().__init__(self.URL, self.NAME, include_header=False, **kwargs)
 
     def _find_url(self):
-        request = urllib.request.Request(self.URL, headers=datasets.QUERY_HEADERS)
-        with urllib.request.urlopen(request) as url:
-            dom = url.read().decode()
+        dom = datasets.SCHEDULER.fetch(self.URL, headers=datasets.QUERY_HEADERS).decode()
 
         pattern = r'<a [^>]*href="([^"]+)">陽性確認者一覧[^<]*</a>'
         url = re.search(pattern, dom).group(1)
         return f'{self.BASE_URL}{url}'
 
+    def _fetch_source(self):
+        return datasets.SCHEDULER.fetch(self._find_url(), headers=datasets.QUERY_HEADERS)
+
     def _localize(self):
         self.dataframe = self.dataframe.iloc[:, 1:]
         self._localize_column_names()
@@ -300,15 +553,19 @@ class PatientByCitySaitamaDataset(datasets.PdfDataset):
         return self.dataframe
 
 
+@registry.register(encoding='cp932')
 class PatientByCityKanagawaDataset(datasets.CsvDataset):
     URL = 'http://www.pref.kanagawa.jp/osirase/1369/data/csv/patient.csv'
     NAME = 'patient-by-city-kanagawa'
+    SCHEMA = {'columns': 4}
 
     COL_DATE = 'Date'
     COL_LOCATION = 'Location'
     COL_AGE = 'Age'
     COL_SEX = 'Sex'
 
+    PARTITIONABLE = True
+
     def __init__(self, **kwargs):
         super().__init__(self.URL, self.NAME, **kwargs)
 
@@ -317,11 +574,7 @@ class PatientByCityKanagawaDataset(datasets.CsvDataset):
         self._localize_age(self.COL_AGE)
         self._localize_sex(self.COL_SEX)
 
-        self.dataframe[self.COL_LOCATION] = self.dataframe[self.COL_LOCATION].str.replace('神奈川県', '')
-        self.dataframe[self.COL_LOCATION] = self.dataframe[self.COL_LOCATION].str.replace('内', '')
-        self.dataframe[self.COL_LOCATION] = self.dataframe[self.COL_LOCATION].str.replace('保健所管', '')
-        self.dataframe[self.COL_LOCATION] = self.dataframe[self.COL_LOCATION].str.replace('及び都', '')
-        self.dataframe[self.COL_LOCATION] = self.dataframe[self.COL_LOCATION].str.replace('保健福祉事務所管', '市')
+        self._rewrite(self.COL_LOCATION, localization.LOCATION_REWRITES['神奈川県'])
         self._localize_location(
             column=self.COL_LOCATION,
             localization_dict=localization.KANAGAWA_CITIES,
@@ -332,9 +585,12 @@ class PatientByCityKanagawaDataset(datasets.CsvDataset):
         return self.dataframe
 
 
+@registry.register()
 class PatientByCityChibaDataset(datasets.JsonDataset):
     URL = 'https://raw.githubusercontent.com/civictechzenchiba/covid19-chiba/development/data/data.json'
     NAME = 'patient-by-city-chiba'
+    RECORD_PATH = 'patients.data[]'
+    SCHEMA = {'keys': ['patients.data'], 'records': 'patients.data', 'columns': 7}
 
     COL_DATE_JP = 'Date_JP'
     COL_DOW = 'Day of Week'
@@ -344,14 +600,14 @@ class PatientByCityChibaDataset(datasets.JsonDataset):
     COL_DISCHARGED = 'Discharged'
     COL_DATE = 'Date'
 
+    DATE_OUTPUT_FORMATS = {COL_DATE: ('%Y-%m-%dT%H:%M:%S.000Z', None)}
+
     def __init__(self, **kwargs):
         super().__init__(self.URL, self.NAME, **kwargs)
 
-    def _create_dataframe_from_json(self):
-        return pd.DataFrame(self.json['patients']['data'])
-
     def _cleanse(self):
         self.dataframe.drop(columns=[self.COL_DATE_JP, self.COL_DOW], inplace=True)
+        self._localize_date(self.COL_DATE, datasets.DATE_ISO)
 
     def _localize(self):
         self._localize_column_names()
@@ -369,9 +625,12 @@ class PatientByCityChibaDataset(datasets.JsonDataset):
         return self.dataframe
 
 
+@registry.register()
 class PatientByCityFukuokaDataset(datasets.JsonDataset):
     URL = 'https://raw.githubusercontent.com/Code-for-Fukuoka/covid19-fukuoka/development/data/data.json'
     NAME = 'patient-by-city-fukuoka'
+    RECORD_PATH = 'patients.data[]'
+    SCHEMA = {'keys': ['patients.data'], 'records': 'patients.data', 'columns': 8}
 
     COL_DATE_JP = 'Date_JP'
     COL_DOW = 'Day of Week'
@@ -382,14 +641,14 @@ class PatientByCityFukuokaDataset(datasets.JsonDataset):
     COL_INFECTED_METHOD = 'Infected method'
     COL_DATE = 'Date'
 
+    DATE_OUTPUT_FORMATS = {COL_DATE: ('%Y-%m-%dT%H:%M:%S.000Z', None)}
+
     def __init__(self, **kwargs):
         super().__init__(self.URL, self.NAME, **kwargs)
 
-    def _create_dataframe_from_json(self):
-        return pd.DataFrame(self.json['patients']['data'])
-
     def _cleanse(self):
         self.dataframe.drop(columns=[self.COL_DATE_JP, self.COL_DOW], inplace=True)
+        self._localize_date(self.COL_DATE, datasets.DATE_ISO)
 
     def _localize(self):
         self._localize_column_names()
@@ -406,9 +665,12 @@ class PatientByCityFukuokaDataset(datasets.JsonDataset):
         return self.dataframe
 
 
+@registry.register()
 class PatientByCityHyogoDataset(datasets.JsonDataset):
     URL = 'https://raw.githubusercontent.com/stop-covid19-hyogo/covid19/development/data/patients.json'
     NAME = 'patient-by-city-hyogo'
+    RECORD_PATH = 'data[]'
+    SCHEMA = {'keys': ['data'], 'records': 'data', 'columns': 9}
 
     COL_ID = 'Id'
     COL_DATE_JP = 'Date_JP'
@@ -420,14 +682,14 @@ class PatientByCityHyogoDataset(datasets.JsonDataset):
     COL_REF = 'Reference'
     COL_DATE = 'Date'
 
+    DATE_OUTPUT_FORMATS = {COL_DATE: ('%Y-%m-%dT%H:%M:%S.000Z', None)}
+
     def __init__(self, **kwargs):
         super().__init__(self.URL, self.NAME, **kwargs)
 
-    def _create_dataframe_from_json(self):
-        return pd.DataFrame(self.json['data'])
-
     def _cleanse(self):
         self.dataframe.drop(columns=[self.COL_DATE_JP, self.COL_DOW, self.COL_REF], inplace=True)
+        self._localize_date(self.COL_DATE, datasets.DATE_ISO)
 
     def _localize(self):
         self._localize_column_names()
@@ -444,15 +706,24 @@ class PatientByCityHyogoDataset(datasets.JsonDataset):
 
 
 class ClinicDataset(datasets.CsvDataset):
+    URL = 'clinics/tabula-{}.csv'
+    NAME = 'clinic-{}'
+
     COL_ID = 'Id'
     COL_NAME = 'Name'
     COL_POSTAL_CODE = 'Postal Code'
     COL_ADDRESS = 'Address'
     COL_TEL = 'Tel'
     COL_WEBSITE = 'Website'
-
-    def __init__(self, url, name, **kwargs):
-        super().__init__(url, name, **kwargs)
+    COL_PREFECTURE = 'Prefecture'
+
+    def __init__(self, prefecture, **kwargs):
+        self.prefecture = prefecture
+        super().__init__(
+            self.URL.format(prefecture.lower()),
+            self.NAME.format(prefecture.lower()),
+            **kwargs
+        )
 
     def _localize(self):
         pass
@@ -486,6 +757,47 @@ class ClinicDataset(datasets.CsvDataset):
 
         return self.dataframe
 
+    def postal_code_index(self, prefix_length=POSTAL_CODE_SHARD_LENGTH):
+        """Group clinics by the leading digits of their 7-digit postal code.
+
+        returns
+            {prefix: {postal_code: [clinic, ...]}}
+        """
+        postal_codes = (
+            self.dataframe[self.COL_POSTAL_CODE]
+            .str.replace(r'\.0$', '', regex=True)
+            .str.replace(r'[^0-9]', '', regex=True)
+            .str.zfill(7)
+        )
+        records = self.dataframe[[
+            self.COL_ID,
+            self.COL_NAME,
+            self.COL_ADDRESS,
+            self.COL_TEL,
+            self.COL_WEBSITE,
+        ]].assign(**{self.COL_PREFECTURE: self.prefecture}).to_dict(orient='records')
+
+        index = {}
+        for postal_code, record in zip(postal_codes, records):
+            if len(postal_code) != 7:
+                continue
+            shard = index.setdefault(postal_code[:prefix_length], {})
+            shard.setdefault(postal_code, []).append(record)
+
+        return index
+
+    def search_documents(self):
+        """Documents for the clinic search index, keyed by '<prefecture>/<id>'."""
+        prefix = self.prefecture.lower()
+        return [
+            (f'{prefix}/{clinic_id}', [name, address])
+            for clinic_id, name, address in zip(
+                self.dataframe[self.COL_ID],
+                self.dataframe[self.COL_NAME],
+                self.dataframe[self.COL_ADDRESS],
+            )
+        ]
+
 
 def init_firebase_app():
     cred = credentials.Certificate(FIREBASE_PRIVATE_KEY)
@@ -503,20 +815,20 @@ def init_firebase_app():
 
 def get_data_from_mhlw():
     NEW_CASE_DAILY_CSV = 'https://www.mhlw.go.jp/content/pcr_positive_daily.csv'
-    new_cases = pd.read_csv(NEW_CASE_DAILY_CSV)
+    new_cases = pd.read_csv(io.BytesIO(datasets.SCHEDULER.fetch(NEW_CASE_DAILY_CSV)))
     new_cases.columns = ['Date', 'Cases']
     cases_total = int(new_cases['Cases'].sum())
     cases_changes = int(new_cases['Cases'].to_list()[-1])
     
     RECOVERED_CSV = 'https://www.mhlw.go.jp/content/recovery_total.csv'
-    recovered = pd.read_csv(RECOVERED_CSV)
+    recovered = pd.read_csv(io.BytesIO(datasets.SCHEDULER.fetch(RECOVERED_CSV)))
     recovered.columns = ['Date', 'Cases']
     recovered_values = recovered['Cases'].to_list()
     recovered_total = int(recovered_values[-1])
     recovered_changes = int(recovered_values[-1] - recovered_values[-2])
     
     DEATH_CSV = 'https://www.mhlw.go.jp/content/death_total.csv'
-    death = pd.read_csv(DEATH_CSV)
+    death = pd.read_csv(io.BytesIO(datasets.SCHEDULER.fetch(DEATH_CSV)))
     death.columns = ['Date', 'Cases']
     death_values = death['Cases'].astype(int).to_list()
     death_total = int(death_values[-1])
@@ -525,77 +837,268 @@ def get_data_from_mhlw():
     return (cases_total, cases_changes), (recovered_total, recovered_changes), (death_total, death_changes)
 
 
+def get_overall_data():
+    (total_cases, total_cases_changes), (discharged, discharged_changes), (death, death_changes) = get_data_from_mhlw()
+    return {
+        'total_cases': total_cases,
+        'total_cases_changes': total_cases_changes,
+        'discharged': discharged,
+        'discharged_changes': discharged_changes,
+        'death': death,
+        'death_changes': death_changes
+    }
+
+
 def update_cases_recovered_deaths(bucket):
     try:
         print('Getting overall data from MHLW')
-        (total_cases, total_cases_changes), (discharged, discharged_changes), (death, death_changes) = get_data_from_mhlw()
+        overall = get_overall_data()
         print(f'Queried data successfully')
         storage_ref = f'overall.json'
         blob = bucket.blob(storage_ref)
-        blob.upload_from_string(json.dumps({
-            'total_cases': total_cases,
-            'total_cases_changes': total_cases_changes,
-            'discharged': discharged,
-            'discharged_changes': discharged_changes,
-            'death': death,
-            'death_changes': death_changes
-        }), content_type='application/json')
+        blob.upload_from_string(json.dumps(overall), content_type='application/json')
         print(f'Uploaded JSON to Firebase storage')
     except Exception as e:
         print('Failed to crawl data from MHLW')
         traceback.print_exc()
 
 
-def update_clinic(bucket):
-    for pref in localization.PREFECTURES.values():
-        dataset = ClinicDataset(
-            f'clinics/tabula-{pref.lower()}.csv',
-            f'clinic-{pref.lower()}',
-        )
-        print(f'Dataset: {dataset.name}')
-        dataset.query_all()
-        print(f'Queried data successfully')
-        dataset.upload_to_storage(bucket)
-        print(f'Uploaded JSON to Firebase storage')
-        print('-'*20)
-
-
-def update_detailed_data(bucket):
-    all_datasets = (
-        TokyoPatientsDataset(),
-        PrefectureByDateDataset(),
-        # PatientDetailsDataset(),
-        PatientByCityTokyoDataset(),
-        PatientByCityOsakaDataset(),
-        PatientByCitySaitamaDataset(),
-        PatientByCityKanagawaDataset(encoding='cp932'),
-        PatientByCityChibaDataset(),
-        PatientByCityFukuokaDataset(),
-        PatientByCityHyogoDataset(),
-    )
-
-    for dataset in all_datasets:
-        try:
+def query_clinic(prefecture):
+    dataset = ClinicDataset(prefecture)
+    dataset.query_all()
+    return dataset
+
+
+def _clinic_cache_path(prefecture):
+    return os.path.join(datasets.CACHE_DIR, 'clinic', f'{prefecture.lower()}.json')
+
+
+def _load_clinic_cache(prefecture, digest):
+    """
+    returns
+        {'payloads': [...], 'postal_index': {...}} derived from the CSV of the
+        same digest in a previous run, or None
+    """
+    path = _clinic_cache_path(prefecture)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        cached = json.load(f)
+    if cached['digest'] != digest:
+        return None
+    return cached
+
+
+def _save_clinic_cache(prefecture, digest, payloads, postal_index):
+    path = _clinic_cache_path(prefecture)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'digest': digest, 'payloads': payloads, 'postal_index': postal_index}, f)
+
+
+def update_clinic(bucket, max_workers=None, bundle=False):
+    """Parse clinic CSVs on a process pool and upload them with postal code and search indexes.
+
+    Parsing runs in worker processes while uploads stay in this process,
+    as the storage bucket cannot be shared with the workers. The raw bytes
+    of each CSV are hashed first: an unchanged CSV is neither parsed nor
+    uploaded again, and its postal code records and search postings come
+    from the local cache.
+
+    bundle
+        also upload all prefectures as a single 'clinic' pack
+    """
+    clinic_bundle = bundles.Bundle('clinic') if bundle else None
+    postal_index = {}
+    clinic_index = search_index.SearchIndex('clinic')
+
+    cached = {}
+    changed = []
+    digests = {}
+    for prefecture in localization.PREFECTURES.values():
+        digests[prefecture] = datasets.file_digest(ClinicDataset.URL.format(prefecture.lower()))
+        entry = _load_clinic_cache(prefecture, digests[prefecture])
+        if entry is not None and clinic_index.load_cached(prefecture.lower(), digests[prefecture]):
+            cached[prefecture] = entry
+        else:
+            changed.append(prefecture)
+    print(f'Clinic CSVs: {len(changed)} changed, {len(cached)} unchanged')
+
+    def merge(payloads, prefecture_postal_index):
+        if clinic_bundle is not None:
+            clinic_bundle.add_payloads(payloads)
+        for prefix, shard in prefecture_postal_index.items():
+            for postal_code, clinics in shard.items():
+                postal_index.setdefault(prefix, {}).setdefault(postal_code, []).extend(clinics)
+
+    for entry in cached.values():
+        merge([tuple(payload) for payload in entry['payloads']], entry['postal_index'])
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for dataset in executor.map(query_clinic, changed):
             print(f'Dataset: {dataset.name}')
-            dataset.query_all()
             print(f'Queried data successfully')
-            # dataset.save_csv()
-            # print(f'Created local CSV file')
-            dataset.upload_to_storage(bucket)
+            payloads = dataset.serialize()
+            dataset.upload_serialized(bucket, payloads)
             print(f'Uploaded JSON to Firebase storage')
+
+            dataset_postal_index = dataset.postal_code_index()
+            merge(payloads, dataset_postal_index)
+            clinic_index.update(
+                dataset.prefecture.lower(),
+                digests[dataset.prefecture],
+                dataset.search_documents,
+            )
+            _save_clinic_cache(dataset.prefecture, digests[dataset.prefecture], payloads, dataset_postal_index)
             print('-'*20)
-        except Exception:
-            print(f'Failed to get dataset {dataset.name}')
-            traceback.print_exc()
+
+    for prefix, shard in postal_index.items():
+        blob = bucket.blob(f'clinic-postal/{prefix}.json')
+        blob.upload_from_string(json.dumps(shard), content_type='application/json')
+    print(f'Uploaded {len(postal_index)} postal code shards to Firebase storage')
+    clinic_index.upload_to_storage(bucket)
+    if clinic_bundle is not None:
+        clinic_bundle.upload(bucket)
+
+
+def _write_site_data(data_dir, name, data):
+    path = os.path.join(data_dir, f'{name}.json')
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+    print(f'Wrote {path} ({os.path.getsize(path)} bytes)')
+
+
+def export_site_data(data_dir=SITE_DATA_DIR):
+    """Write the headline numbers and the prefecture table into Jekyll's _data/.
+
+    The pages render them into static HTML at build time, and the client
+    side fetch only refreshes them.
+    """
+    updated_at = datetime.datetime.now().strftime('%H:%M %d/%m/%Y')
+    os.makedirs(data_dir, exist_ok=True)
+
+    try:
+        overall = get_overall_data()
+        # Pre-formatted like toLocaleString(), as Liquid has no number delimiter filter
+        overall['text'] = {key: f'{value:,}' for key, value in overall.items()}
+        overall['updated_at'] = updated_at
+        _write_site_data(data_dir, 'overall', overall)
+    except Exception:
+        print('Failed to export overall data')
+        traceback.print_exc()
+
+    try:
+        [dataset], _ = registry.build([PrefectureMetricsDataset.NAME])
+        dataset.query_all()
+        table = dataset.dataframe.sort_values(dataset.COL_CUMULATIVE, ascending=False)
+        _write_site_data(data_dir, 'prefectures', {
+            'date': str(table[dataset.COL_DATE].iloc[0]),
+            'updated_at': updated_at,
+            'rows': [
+                {
+                    'name': dataset.label(dataset.COL_PREFECTURE, name),
+                    'total': f'{int(total):,}',
+                    'new': f'{int(new):,}',
+                    'average': f'{average:.1f}',
+                }
+                for name, total, new, average in zip(
+                    table[dataset.COL_PREFECTURE],
+                    table[dataset.COL_CUMULATIVE],
+                    table[dataset.COL_NEW_CASES],
+                    table[dataset.COL_AVERAGE],
+                )
+            ],
+        })
+    except Exception:
+        print('Failed to export prefecture table')
+        traceback.print_exc()
+
+
+def detailed_datasets(patterns=None):
+    selected, _ = registry.build(patterns)
+    return selected
+
+
+def update_detailed_data(bucket, patterns=None, run_profiler=None, bundle=False, memory_budget=None):
+    """Run the registered datasets matching the glob patterns, all of them if None.
+
+    run_profiler
+        profiler.Profiler capturing the stages of the datasets
+    bundle
+        also upload the DETAILED_BUNDLES packs of the datasets
+    memory_budget
+        bytes per dataset, overriding COVID_MEMORY_BUDGET
+    """
+    all_datasets, instances = registry.build(patterns)
+    if memory_budget is not None:
+        for dataset in instances.values():
+            dataset.memory_budget = memory_budget
+    print(f'Datasets: {", ".join(dataset.name for dataset in all_datasets)}')
+    bundler = None
+    if bundle:
+        bundler = bundles.Bundler([
+            bundles.Bundle(name, p, expected=registry.select(p)) for name, p in DETAILED_BUNDLES.items()
+        ])
+    pipeline.Pipeline(
+        bucket,
+        journal=pipeline.RunJournal(),
+        profiler=run_profiler,
+        bundler=bundler,
+        memory_monitor=memory.MemoryMonitor(),
+    ).run(all_datasets)
 
 
 def main(args=None):
+    parser = argparse.ArgumentParser(description='Update the data files of the site.')
+    parser.add_argument(
+        '--export-site-data', nargs='?', const=SITE_DATA_DIR, metavar='DIR',
+        help=f'only write the data rendered at build time into DIR (default: {SITE_DATA_DIR})',
+    )
+    parser.add_argument(
+        '--only', nargs='+', metavar='PATTERN',
+        help='only run the registered datasets matching these glob patterns, e.g. "patient-by-city-*" or "*"',
+    )
+    parser.add_argument(
+        '--profile', nargs='*', metavar='PATTERN',
+        help=f'with --only, profile the stages of the datasets matching these patterns, all if none are '
+             f'given (or set {profiler.PROFILE_ENV}); captures are written to {datasets.CACHE_DIR}/profiles/',
+    )
+    parser.add_argument('--bundle', action='store_true', help='also upload related artifacts packed into bundles')
+    parser.add_argument(
+        '--clinic', action='store_true',
+        help='also parse the clinic CSVs and upload them with the postal code and search indexes',
+    )
+    parser.add_argument(
+        '--memory-budget', type=float, metavar='MB',
+        help=f'memory budget of each dataset, past which its steps spill to {datasets.SPILL_DIR} '
+             f'(default: {memory.MEMORY_BUDGET // memory.MB} MB from COVID_MEMORY_BUDGET, 0 for none)',
+    )
+    options = parser.parse_args(args)
+    run_profiler = profiler.Profiler.from_env()
+    if options.profile is not None:
+        run_profiler = profiler.Profiler(
+            options.profile, mode=os.environ.get(profiler.PROFILE_MODE_ENV, profiler.MODE_SAMPLING))
+    if run_profiler is not None and not options.only:
+        # Only the dataset pipeline is instrumented
+        source = '--profile' if options.profile is not None else profiler.PROFILE_ENV
+        parser.error(f'{source} requires --only')
+
     locale.setlocale(locale.LC_ALL, 'en_US.UTF-8')
+    if options.export_site_data:
+        export_site_data(options.export_site_data)
+        return 0
+
     app, client, bucket = init_firebase_app()
-    update_cases_recovered_deaths(bucket)
-    print('-' * 20)
-    # update_clinic(bucket)
-    # update_detailed_data(bucket)
+    if options.only:
+        memory_budget = None if options.memory_budget is None else int(options.memory_budget * memory.MB)
+        update_detailed_data(bucket, options.only, run_profiler, bundle=options.bundle, memory_budget=memory_budget)
+    else:
+        update_cases_recovered_deaths(bucket)
+    if options.clinic:
+        print('-' * 20)
+        update_clinic(bucket, bundle=options.bundle)
 
     return 0
 